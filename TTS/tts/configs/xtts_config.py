@@ -56,6 +56,13 @@ class XttsConfig(BaseTTSConfig):
         sound_norm_refs (bool):
             Whether to normalize the conditioning audio. Defaults to `False`.
 
+        speaker_cache_size (int):
+            Number of reference voices whose conditioning latents are kept in memory by `get_conditioning_latents()`.
+            0 disables the cache. Defaults to `0`.
+
+        speaker_cache_dir (str):
+            Directory where the cached conditioning latents are also saved, so they survive restarts. Defaults to None.
+
     Note:
         Check :class:`TTS.tts.configs.shared_configs.BaseTTSConfig` for the inherited parameters.
 
@@ -106,3 +113,7 @@ class XttsConfig(BaseTTSConfig):
     gpt_cond_chunk_len: int = 4
     max_ref_len: int = 10
     sound_norm_refs: bool = False
+
+    # speaker latent cache
+    speaker_cache_size: int = 0
+    speaker_cache_dir: str = None
@@ -7,6 +7,7 @@ import random
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from transformers import GPT2Config
 
 from TTS.tts.layers.xtts.gpt_inference import GPT2InferenceModel
@@ -18,6 +19,16 @@ def null_position_embeddings(range, dim):
     return torch.zeros((range.shape[0], range.shape[1], dim), device=range.device)
 
 
+def checkpoint_flagged_blocks(function, *args, **kwargs):
+    """`GPT2Model._gradient_checkpointing_func` that only recomputes the blocks flagged with `checkpoint_activations`.
+
+    `function` is the bound `__call__` of the transformer block.
+    """
+    if getattr(function.__self__, "checkpoint_activations", False):
+        return checkpoint(function, *args, use_reentrant=False, **kwargs)
+    return function(*args, **kwargs)
+
+
 class LearnedPositionEmbeddings(nn.Module):
     def __init__(self, seq_len, model_dim, init=0.02, relative=False):
         super().__init__()
@@ -48,23 +59,40 @@ def build_hf_gpt_transformer(
     max_text_seq_len,
     max_prompt_len,
     checkpointing,
+    attn_implementation=None,
 ):
     """
     GPT-2 implemented by the HuggingFace library.
+
+    `attn_implementation` selects the attention kernel of the transformer blocks: "eager" (reference), "sdpa"
+    (`torch.nn.functional.scaled_dot_product_attention`, which dispatches to fused flash/memory-efficient kernels on
+    CUDA) or "flash_attention_2" (needs the `flash_attn` package and fp16/bf16 weights). None lets transformers pick
+    one. A kernel the installed versions do not support falls back to the default.
     """
     from transformers import GPT2Config, GPT2Model
 
-    gpt_config = GPT2Config(
-        vocab_size=256,  # Unused.
-        n_positions=max_mel_seq_len + max_text_seq_len + max_prompt_len,
-        n_ctx=max_mel_seq_len + max_text_seq_len + max_prompt_len,
-        n_embd=model_dim,
-        n_layer=layers,
-        n_head=heads,
-        gradient_checkpointing=checkpointing,
-        use_cache=not checkpointing,
-    )
-    gpt = GPT2Model(gpt_config)
+    def _build(**kwargs):
+        gpt_config = GPT2Config(
+            vocab_size=256,  # Unused.
+            n_positions=max_mel_seq_len + max_text_seq_len + max_prompt_len,
+            n_ctx=max_mel_seq_len + max_text_seq_len + max_prompt_len,
+            n_embd=model_dim,
+            n_layer=layers,
+            n_head=heads,
+            gradient_checkpointing=checkpointing,
+            use_cache=not checkpointing,
+            **kwargs,
+        )
+        return GPT2Model(gpt_config)
+
+    if attn_implementation is None:
+        gpt = _build()
+    else:
+        try:
+            gpt = _build(attn_implementation=attn_implementation)
+        except (ImportError, ValueError) as e:
+            print(f" > {attn_implementation} attention is not available, using the default attention: {e}")
+            gpt = _build()
     # Override the built in positional embeddings
     del gpt.wpe
     gpt.wpe = functools.partial(null_position_embeddings, dim=model_dim)
@@ -108,6 +136,7 @@ class GPT(nn.Module):
         label_smoothing=0.0,
         use_perceiver_resampler=False,
         perceiver_cond_length_compression=256,
+        attn_implementation=None,
     ):
         """
         Args:
@@ -156,6 +185,7 @@ class GPT(nn.Module):
             self.max_text_tokens,
             self.max_prompt_tokens,
             checkpointing,
+            attn_implementation,
         )
         if train_solo_embeddings:
             self.mel_solo_embedding = nn.Parameter(torch.randn(1, 1, model_dim) * 0.02, requires_grad=True)
@@ -242,6 +272,20 @@ class GPT(nn.Module):
         pass
 
 
+    def set_gradient_checkpointing(self, every_n_layers=1):
+        """Recompute the activations of one transformer block out of `every_n_layers` in the backward pass instead of
+        storing them, 0 disables it. Only applies in training mode.
+        """
+        for i, block in enumerate(self.gpt.h):
+            block.checkpoint_activations = every_n_layers > 0 and i % every_n_layers == 0
+        self.gpt.gradient_checkpointing = every_n_layers > 0
+        self.gpt._gradient_checkpointing_func = checkpoint_flagged_blocks
+
+    def freeze_layers(self, num_layers):
+        """Freeze the `num_layers` lowest transformer blocks."""
+        for block in self.gpt.h[:num_layers]:
+            block.requires_grad_(False)
+
     def get_grad_norm_parameter_groups(self):
         return {
             "conditioning_encoder": list(self.conditioning_encoder.parameters()),
@@ -252,7 +296,7 @@ class GPT(nn.Module):
             "heads": list(self.text_head.parameters()) + list(self.mel_head.parameters()),
         }
 
-    def init_gpt_for_inference(self, kv_cache=True, use_deepspeed=False):
+    def init_gpt_for_inference(self, kv_cache=True, use_deepspeed=False, static_cache=False):
         seq_length = self.max_prompt_tokens + self.max_mel_tokens + self.max_text_tokens + 1
         gpt_config = GPT2Config(
             vocab_size=self.max_mel_tokens,
@@ -272,6 +316,7 @@ class GPT(nn.Module):
             self.final_norm,
             self.mel_head,
             kv_cache=kv_cache,
+            static_cache=static_cache,
         )
         self.gpt.wte = self.mel_embedding
 
@@ -292,6 +337,12 @@ class GPT(nn.Module):
         tar = F.pad(input, (0, 1), value=stop_token)
         return inp, tar
 
+    @staticmethod
+    def length_mask(lengths, max_len):
+        """Boolean mask (b, max_len) that is True on the first `lengths[i]` positions of each row."""
+        positions = torch.arange(max_len, device=lengths.device)
+        return positions.unsqueeze(0) < lengths.unsqueeze(1)
+
     def set_mel_padding(self, mel_input_tokens, code_lengths):
         """
         Given mel tokens that are derived from a padded audio clip and the actual lengths of each batch element in
@@ -299,11 +350,8 @@ class GPT(nn.Module):
         preformatting to create a working TTS model.
         """
         # Set padding areas within MEL (currently it is coded with the MEL code for <zero>).
-        for b in range(len(code_lengths)):
-            actual_end = code_lengths[b]
-            if actual_end < mel_input_tokens.shape[-1]:
-                mel_input_tokens[b, actual_end:] = self.stop_audio_token
-        return mel_input_tokens
+        padding = self.length_mask(code_lengths, mel_input_tokens.shape[-1]).logical_not()
+        return mel_input_tokens.masked_fill_(padding, self.stop_audio_token)
 
     def get_logits(
         self,
@@ -380,45 +428,38 @@ class GPT(nn.Module):
         """
         prompt = prompt_codes
         if self.training:
-            lengths = []
             # Compute the real prompt length based on the first encounter with the token 83 used for padding
-            for i in range(prompt_codes.shape[0]):
-                length = 0
-                for j in range(prompt_codes.shape[1]):
-                    if prompt_codes[i, j] == 83:
-                        break
-                    else:
-                        length += 1
-                lengths.append(length)
+            is_padding = prompt_codes == 83
+            lengths = torch.where(is_padding.any(dim=1), is_padding.int().argmax(dim=1), prompt_codes.shape[1])
 
             # prompt_len = random.randint(1, 9)  # in secs
             prompt_len = 3
             prompt_len = prompt_len * 24  # in frames
             if prompt_codes.shape[-1] >= prompt_len:
-                for i in range(prompt_codes.shape[0]):
-                    if lengths[i] < prompt_len:
-                        start = 0
-                    else:
-                        start = random.randint(0, lengths[i] - prompt_len)
-                prompt = prompt_codes[:, start : start + prompt_len]
+                # random crop of each row within its real length, rows shorter than the crop start at 0
+                max_start = (lengths - prompt_len).clamp(min=0)
+                start = (torch.rand(lengths.shape, device=lengths.device) * (max_start + 1)).long()
+                index = start.unsqueeze(1) + torch.arange(prompt_len, device=lengths.device).unsqueeze(0)
+                prompt = prompt_codes.gather(1, index)
 
         # add start and stop tokens
         prompt = F.pad(prompt, (1, 0), value=self.start_prompt_token)
         prompt = F.pad(prompt, (0, 1), value=self.stop_prompt_token)
         return prompt
 
-    def get_style_emb(self, cond_input, return_latent=False):
+    def get_style_emb(self, cond_input, return_latent=False, cond_mask=None):
         """
         cond_input: (b, 80, s) or (b, 1, 80, s)
+        cond_mask: (b, s) bool of the valid frames when cond_input is a padded batch
         conds: (b, 1024, s)
         """
         conds = None
         if not return_latent:
             if cond_input.ndim == 4:
                 cond_input = cond_input.squeeze(1)
-            conds = self.conditioning_encoder(cond_input)  # (b, d, s)
+            conds = self.conditioning_encoder(cond_input, mask=cond_mask)  # (b, d, s)
             if self.use_perceiver_resampler:
-                conds = self.conditioning_perceiver(conds.permute(0, 2, 1)).transpose(1, 2)  # (b, d, 32)
+                conds = self.conditioning_perceiver(conds.permute(0, 2, 1), mask=cond_mask).transpose(1, 2)  # (b, d, 32)
         else:
             # already computed
             conds = cond_input.unsqueeze(1)
@@ -466,11 +507,10 @@ class GPT(nn.Module):
 
         if cond_idxs is not None:
             # recompute cond idxs for mel lengths
-            for idx in range(cond_idxs.size(0)):
-                if self.use_perceiver_resampler:
-                    cond_idxs[idx] = cond_idxs[idx] // self.perceiver_cond_length_compression
-                else:
-                    cond_idxs[idx] = cond_idxs[idx] // self.code_stride_len
+            if self.use_perceiver_resampler:
+                cond_idxs = cond_idxs // self.perceiver_cond_length_compression
+            else:
+                cond_idxs = cond_idxs // self.code_stride_len
 
         # ensure that the cond_mel does not have padding
         # if cond_lens is not None and cond_idxs is None:
@@ -516,39 +556,20 @@ class GPT(nn.Module):
         attn_mask_text = None
         attn_mask_mel = None
         if not return_latent:
-            attn_mask_cond = torch.ones(
-                cond_mels.shape[0],
-                cond_mels.shape[-1],
-                dtype=torch.bool,
-                device=text_inputs.device,
-            )
-            attn_mask_text = torch.ones(
-                text_inputs.shape[0],
-                text_inputs.shape[1],
-                dtype=torch.bool,
-                device=text_inputs.device,
-            )
-            attn_mask_mel = torch.ones(
-                audio_codes.shape[0],
-                audio_codes.shape[1],
-                dtype=torch.bool,
-                device=audio_codes.device,
-            )
-
             if cond_idxs is not None:
                 # use masking approach
-                for idx, r in enumerate(cond_idxs):
-                    l = r[1] - r[0]
-                    attn_mask_cond[idx, l:] = 0.0
+                attn_mask_cond = self.length_mask(cond_idxs[:, 1] - cond_idxs[:, 0], cond_mels.shape[-1])
             elif cond_lens is not None:
-                for idx, l in enumerate(cond_lens):
-                    attn_mask_cond[idx, l:] = 0.0
-
-            for idx, l in enumerate(text_lengths):
-                attn_mask_text[idx, l + 1 :] = 0.0
-
-            for idx, l in enumerate(code_lengths):
-                attn_mask_mel[idx, l + 1 :] = 0.0
+                attn_mask_cond = self.length_mask(cond_lens, cond_mels.shape[-1])
+            else:
+                attn_mask_cond = torch.ones(
+                    cond_mels.shape[0],
+                    cond_mels.shape[-1],
+                    dtype=torch.bool,
+                    device=text_inputs.device,
+                )
+            attn_mask_text = self.length_mask(text_lengths + 1, text_inputs.shape[1])
+            attn_mask_mel = self.length_mask(code_lengths + 1, audio_codes.shape[1])
 
         # Compute text embeddings + positional embeddings
         text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
@@ -584,11 +605,10 @@ class GPT(nn.Module):
             return mel_logits
 
         # Set paddings to -1 to ignore them in loss
-        for idx, l in enumerate(text_lengths):
-            text_targets[idx, l + 1 :] = -1
-
-        for idx, l in enumerate(code_lengths):
-            mel_targets[idx, l + 1 :] = -1
+        text_targets = text_targets.masked_fill(
+            self.length_mask(text_lengths + 1, text_targets.shape[1]).logical_not(), -1
+        )
+        mel_targets = mel_targets.masked_fill(self.length_mask(code_lengths + 1, mel_targets.shape[1]).logical_not(), -1)
 
         # check if stoptoken is in every row of mel_targets
         assert (mel_targets == self.stop_audio_token).sum() >= mel_targets.shape[
@@ -596,11 +616,10 @@ class GPT(nn.Module):
         ], f" ❗ mel_targets does not contain stop token ({self.stop_audio_token}) in every row."
 
         # ignore the loss for the segment used for conditioning
-        # coin flip for the segment to be ignored
         if cond_idxs is not None:
-            cond_start = cond_idxs[idx, 0]
-            cond_end = cond_idxs[idx, 1]
-            mel_targets[idx, cond_start:cond_end] = -1
+            positions = torch.arange(mel_targets.shape[1], device=mel_targets.device).unsqueeze(0)
+            cond_segment = (positions >= cond_idxs[:, :1]) & (positions < cond_idxs[:, 1:])
+            mel_targets = mel_targets.masked_fill(cond_segment, -1)
 
         # Compute losses
         loss_text = F.cross_entropy(
@@ -615,15 +634,45 @@ class GPT(nn.Module):
         self.compute_embeddings(cond_latents, text_inputs)
         return self.generate(cond_latents, text_inputs, **hf_generate_kwargs)
 
+    def get_prefix_emb(self, cond_latents, text_inputs, text_lengths=None):
+        """
+        Embed `[cond_latents, start_text, text_inputs, stop_text]`, the prefix the mel tokens are generated after.
+
+        When `text_lengths` is given, `text_inputs` is a right padded batch of ragged texts. Each row is embedded at
+        its own length and then shifted to the right so that every prefix ends at the last position, which lets the
+        whole batch start generating at the same step.
+
+        Returns the prefix embeddings (b, s, d) and a boolean mask (b, s) that is False on the left padding.
+        """
+        if text_lengths is None:
+            text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+            text_inputs = F.pad(text_inputs, (1, 0), value=self.start_text_token)
+            emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+            emb = torch.cat([cond_latents, emb], dim=1)
+            return emb, torch.ones(emb.shape[:2], dtype=torch.bool, device=emb.device)
+
+        text_lengths = text_lengths.to(text_inputs.device).unsqueeze(1)
+        positions = torch.arange(text_inputs.shape[1] + 2, device=text_inputs.device).unsqueeze(0)
+        text_inputs = F.pad(text_inputs, (1, 1), value=self.stop_text_token)
+        text_inputs = text_inputs.masked_fill(positions == 0, self.start_text_token)
+        text_inputs = text_inputs.masked_fill(positions > text_lengths, self.stop_text_token)
+        emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+        emb = torch.cat([cond_latents, emb], dim=1)
+
+        # move the right padding of each row to its left
+        shift = text_inputs.shape[1] - (text_lengths + 2)
+        positions = torch.arange(emb.shape[1], device=emb.device).unsqueeze(0)
+        index = (positions - shift) % emb.shape[1]
+        emb = emb.gather(1, index.unsqueeze(-1).expand(-1, -1, emb.shape[-1]))
+        return emb, positions >= shift
+
     def compute_embeddings(
         self,
         cond_latents,
         text_inputs,
+        text_lengths=None,
     ):
-        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
-        text_inputs = F.pad(text_inputs, (1, 0), value=self.start_text_token)
-        emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
-        emb = torch.cat([cond_latents, emb], dim=1)
+        emb, prefix_mask = self.get_prefix_emb(cond_latents, text_inputs, text_lengths)
         self.gpt_inference.store_prefix_emb(emb)
         gpt_inputs = torch.full(
             (
@@ -635,15 +684,33 @@ class GPT(nn.Module):
             device=text_inputs.device,
         )
         gpt_inputs[:, -1] = self.start_audio_token
+        if text_lengths is not None:
+            return gpt_inputs, F.pad(prefix_mask, (0, 1), value=True).long()
         return gpt_inputs
 
     def generate(
         self,
         cond_latents,
         text_inputs,
+        text_lengths=None,
+        return_latents=False,
         **hf_generate_kwargs,
     ):
-        gpt_inputs = self.compute_embeddings(cond_latents, text_inputs)
+        """
+        Generate audio codes. With `return_latents`, also return their latents (see `get_latents`) collected from the
+        hidden states of the decoding steps instead of a second forward pass. Not supported with beam search, whose
+        steps are reordered.
+        """
+        if return_latents:
+            assert hf_generate_kwargs.get("num_beams", 1) == 1, " ❗ Latents can not be collected with beam search."
+            hf_generate_kwargs.update(output_hidden_states=True, return_dict_in_generate=True)
+        if text_lengths is not None:
+            # ragged batch: keep the left padding of the prefixes out of the attention
+            gpt_inputs, hf_generate_kwargs["attention_mask"] = self.compute_embeddings(
+                cond_latents, text_inputs, text_lengths
+            )
+        else:
+            gpt_inputs = self.compute_embeddings(cond_latents, text_inputs)
         gen = self.gpt_inference.generate(
             gpt_inputs,
             bos_token_id=self.start_audio_token,
@@ -652,10 +719,32 @@ class GPT(nn.Module):
             max_length=self.max_gen_mel_tokens + gpt_inputs.shape[-1],
             **hf_generate_kwargs,
         )
+        if return_latents:
+            # last position of each step, i.e. the inputs [start_audio, codes[:-1]]
+            hidden_states = torch.cat([step_states[-1][:, -1:] for step_states in gen.hidden_states], dim=1)
+            return gen.sequences[:, gpt_inputs.shape[1] :], self.final_norm(hidden_states)
         if "return_dict_in_generate" in hf_generate_kwargs:
             return gen.sequences[:, gpt_inputs.shape[1] :], gen
         return gen[:, gpt_inputs.shape[1] :]
 
+    def get_latents(self, cond_latents, text_inputs, audio_codes, text_lengths=None):
+        """
+        Compute the latents of generated `audio_codes`, i.e. the final norm hidden states of the mel inputs
+        `[start_audio, audio_codes[:-1]]` that the HiFi-GAN decoder consumes.
+
+        Unlike `forward(..., return_latent=True)` it supports ragged batches (see `get_prefix_emb`). Rows shorter than
+        `audio_codes` can be padded with any code since the positions after their end never affect their latents.
+        """
+        prefix_emb, prefix_mask = self.get_prefix_emb(cond_latents, text_inputs, text_lengths)
+        mel_inputs = F.pad(audio_codes[:, :-1], (1, 0), value=self.start_audio_token)
+        mel_emb = self.mel_embedding(mel_inputs) + self.mel_pos_embedding(mel_inputs)
+        gpt_out = self.gpt(
+            inputs_embeds=torch.cat([prefix_emb, mel_emb], dim=1),
+            attention_mask=F.pad(prefix_mask, (0, mel_emb.shape[1]), value=True),
+            return_dict=True,
+        )
+        return self.final_norm(gpt_out.last_hidden_state[:, prefix_emb.shape[1] :])
+
     def get_generator(self, fake_inputs, **hf_generate_kwargs):
         return self.gpt_inference.generate_stream(
             fake_inputs,
@@ -1,15 +1,18 @@
 import math
 
 import torch
+import torch.nn.functional as F
 from torch import nn
 from transformers import GPT2PreTrainedModel
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 
+from TTS.tts.layers.xtts.kv_cache import StaticKVCache, gpt2_cached_forward
+
 
 class GPT2InferenceModel(GPT2PreTrainedModel):
     """Override GPT2LMHeadModel to allow for prefix conditioning."""
 
-    def __init__(self, config, gpt, pos_emb, embeddings, norm, linear, kv_cache):
+    def __init__(self, config, gpt, pos_emb, embeddings, norm, linear, kv_cache, static_cache=False):
         super().__init__(config)
         self.transformer = gpt
         self.pos_embedding = pos_emb
@@ -17,6 +20,9 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.final_norm = norm
         self.lm_head = nn.Sequential(norm, linear)
         self.kv_cache = kv_cache
+        # preallocated `StaticKVCache` of `config.n_positions` positions, reused across generate calls
+        self.static_cache = static_cache and kv_cache
+        self.static_kv = None
 
     def store_prefix_emb(self, prefix_emb):
         self.cached_prefix_emb = prefix_emb
@@ -94,6 +100,9 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             emb = emb + self.pos_embedding.get_fixed_embedding(
                 attention_mask.shape[1] - (prefix_len + 1), attention_mask.device
             )
+        if self.static_cache:
+            return self.static_cache_forward(emb, attention_mask, output_hidden_states, return_dict)
+
         transformer_outputs = self.transformer(
             inputs_embeds=emb,
             past_key_values=past_key_values,
@@ -114,15 +123,65 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         if not return_dict:
             return (lm_logits,) + transformer_outputs[1:]
 
+        # only the last layer is used (see `GPT.generate`), `generate()` keeps the hidden states of every step
+        hidden_states = transformer_outputs.hidden_states
+        if hidden_states is not None:
+            hidden_states = hidden_states[-1:]
         return CausalLMOutputWithCrossAttentions(
             loss=None,
             logits=lm_logits,
             past_key_values=transformer_outputs.past_key_values,
-            hidden_states=transformer_outputs.hidden_states,
+            hidden_states=hidden_states,
             attentions=transformer_outputs.attentions,
             cross_attentions=transformer_outputs.cross_attentions,
         )
 
+    def static_cache_forward(self, emb, attention_mask, output_hidden_states=None, return_dict=None):
+        """Forward of `emb` reading and writing `static_kv` in place.
+
+        The whole prefix is written on the first step. Each following step writes its single position and attends over
+        the full cache, so every decoding step has the same shapes. The cache itself is returned as `past_key_values`
+        to keep `generate()` feeding only the last token.
+        """
+        batch_size, seq_len, _ = emb.shape
+        if attention_mask is None:
+            attention_mask = torch.ones(batch_size, seq_len, dtype=torch.long, device=emb.device)
+        if seq_len != 1:
+            if self.static_kv is None or self.static_kv.batch_size != batch_size:
+                self.static_kv = StaticKVCache.from_gpt2(self.transformer, batch_size, self.config.n_positions)
+            positions = torch.arange(seq_len, device=emb.device).unsqueeze(0).expand(batch_size, -1)
+            causal_mask = torch.ones(seq_len, seq_len, dtype=torch.bool, device=emb.device).tril()
+            # every position attends at least to itself so the left padding does not produce NaNs
+            attention_mask = (causal_mask & attention_mask.bool()[:, None, None, :]) | torch.eye(
+                seq_len, dtype=torch.bool, device=emb.device
+            )
+            hidden_states = gpt2_cached_forward(
+                self.transformer, emb, self.static_kv, positions, attention_mask, length=seq_len
+            )
+        else:
+            positions = torch.full((batch_size, 1), attention_mask.shape[1] - 1, device=emb.device)
+            attention_mask = F.pad(attention_mask.bool(), (0, self.static_kv.max_len - attention_mask.shape[1]))
+            hidden_states = self.static_decode_step(emb, positions, attention_mask[:, None, None, :])
+        lm_logits = self.lm_head(hidden_states)
+
+        all_hidden_states = (hidden_states,) if output_hidden_states else None
+        if not return_dict:
+            return tuple(v for v in (lm_logits, self.static_kv, all_hidden_states) if v is not None)
+
+        return CausalLMOutputWithCrossAttentions(
+            loss=None,
+            logits=lm_logits,
+            past_key_values=self.static_kv,
+            hidden_states=all_hidden_states,
+        )
+
+    def static_decode_step(self, emb, positions, attention_mask):
+        """One decoding step over the full static cache.
+
+        All the shapes only depend on the batch size, so this method can be wrapped with `torch.compile()` or traced.
+        """
+        return gpt2_cached_forward(self.transformer, emb, self.static_kv, positions, attention_mask)
+
     @staticmethod
     def _reorder_cache(past, beam_idx):
         """
@@ -130,6 +189,9 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         :meth:`~transformers.PreTrainedModel.beam_search` or :meth:`~transformers.PreTrainedModel.beam_sample` is
         called. This is required to match :obj:`past_key_values` with the correct beam_idx at every generation step.
         """
+        if isinstance(past, StaticKVCache):
+            past.reorder_cache(beam_idx)
+            return past
         return tuple(
             tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
             for layer_past in past
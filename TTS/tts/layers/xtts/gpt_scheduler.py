@@ -0,0 +1,223 @@
+import itertools
+from collections import deque
+from dataclasses import dataclass
+from typing import Any
+
+import torch
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from TTS.tts.layers.xtts.kv_cache import StaticKVCache, gpt2_cached_forward
+
+
+@dataclass
+class GenerationResult:
+    """Output of a finished request.
+
+    Args:
+        request_id: Identifier given to `ContinuousBatchingScheduler.add_request()`.
+        codes (Tensor): Generated audio codes (1, m), including the stop token when it was reached.
+        latents (Tensor): GPT latents of the codes (1, m, d), ready for the HiFi-GAN decoder.
+    """
+
+    request_id: Any
+    codes: torch.Tensor
+    latents: torch.Tensor
+
+
+class _Sequence:
+    def __init__(self, request_id, prefix_emb):
+        self.request_id = request_id
+        self.prefix_emb = prefix_emb
+        self.prefix_len = prefix_emb.shape[1]
+        self.length = 0  # number of cached positions
+        self.codes = []
+        self.latents = []
+
+
+class ContinuousBatchingScheduler:
+    """Continuous batching of the autoregressive XTTS GPT decoding.
+
+    Requests join the running decode loop as soon as a slot is free and leave it at their own stop token, so one long
+    utterance does not keep the whole batch alive. Every running sequence owns one row of a `StaticKVCache` with its
+    own prefix length, cache length and mel position. Running sequences always fill the first rows of the cache: when
+    one finishes, the last one is moved into its row, so each step decodes a contiguous slice of the cache.
+
+    Args:
+        gpt (GPT): XTTS GPT initialized for inference (`GPT.init_gpt_for_inference()`).
+        max_batch_size (int): Number of cache slots, i.e. sequences decoded together. Defaults to 8.
+        temperature, top_k, top_p, repetition_penalty, do_sample: Sampling settings shared by all the requests. See
+            `Xtts.inference()`.
+
+    Example:
+        >>> scheduler = ContinuousBatchingScheduler(model.gpt, max_batch_size=8)
+        >>> scheduler.add_request(gpt_cond_latent, text_tokens, request_id="intro")
+        >>> for result in scheduler.run():
+        ...     wav = model.hifigan_decoder(result.latents, g=speaker_embedding)
+    """
+
+    def __init__(
+        self,
+        gpt,
+        max_batch_size=8,
+        temperature=0.75,
+        top_k=50,
+        top_p=0.85,
+        repetition_penalty=10.0,
+        do_sample=True,
+    ):
+        self.gpt = gpt
+        self.model = gpt.gpt_inference
+        self.max_batch_size = max_batch_size
+        self.do_sample = do_sample
+        self.cache = StaticKVCache.from_gpt2(self.model.transformer, max_batch_size, self.model.config.n_positions)
+        self.device = self.cache.keys[0].device
+        # codes of each row as seen by the logits processors: start token then generated codes. The free positions
+        # hold the placeholder id of the prefix (see `GPT.compute_embeddings`) so the penalties match `GPT.generate()`
+        self.input_ids = torch.ones(max_batch_size, gpt.max_gen_mel_tokens + 1, dtype=torch.long, device=self.device)
+
+        self.logits_processor = LogitsProcessorList()
+        if repetition_penalty != 1.0:
+            self.logits_processor.append(RepetitionPenaltyLogitsProcessor(penalty=repetition_penalty))
+        if do_sample:
+            if temperature != 1.0:
+                self.logits_processor.append(TemperatureLogitsWarper(temperature))
+            if top_k > 0:
+                self.logits_processor.append(TopKLogitsWarper(top_k=top_k))
+            if top_p < 1.0:
+                self.logits_processor.append(TopPLogitsWarper(top_p=top_p))
+
+        self.waiting = deque()
+        self.running = []
+        self._request_ids = itertools.count()
+
+    def __len__(self):
+        """Number of requests that are waiting or being decoded."""
+        return len(self.waiting) + len(self.running)
+
+    @torch.inference_mode()
+    def add_request(self, cond_latents, text_tokens, request_id=None):
+        """Queue a request. It joins the decoding at the next `step()` with a free slot.
+
+        Args:
+            cond_latents (Tensor): GPT conditioning latents (1, s, d).
+            text_tokens (Tensor): Text token ids (1, t).
+            request_id: Identifier returned with the result. Defaults to a running counter.
+        """
+        if request_id is None:
+            request_id = next(self._request_ids)
+        prefix_emb, _ = self.gpt.get_prefix_emb(cond_latents.to(self.device), text_tokens.to(self.device))
+        assert (
+            prefix_emb.shape[1] + 1 + self.gpt.max_gen_mel_tokens <= self.cache.max_len
+        ), f" ❗ Request {request_id} does not fit in the cache ({prefix_emb.shape[1]} prefix positions)."
+        self.waiting.append(_Sequence(request_id, prefix_emb))
+        return request_id
+
+    def _prefill(self, seq, row):
+        """Cache the prefix and start token of a new sequence and return the hidden state of the start token."""
+        start_token = torch.full((1, 1), self.gpt.start_audio_token, dtype=torch.long, device=self.device)
+        start_emb = self.model.embeddings(start_token) + self.model.pos_embedding.get_fixed_embedding(0, self.device)
+        emb = torch.cat([seq.prefix_emb.to(start_emb.dtype), start_emb], dim=1)
+        seq_len = emb.shape[1]
+        positions = torch.arange(seq_len, device=self.device).unsqueeze(0)
+        attention_mask = torch.ones(seq_len, seq_len, dtype=torch.bool, device=self.device).tril()[None, None]
+        hidden_states = gpt2_cached_forward(
+            self.model.transformer,
+            emb,
+            self.cache,
+            positions,
+            attention_mask,
+            rows=slice(row, row + 1),
+            length=seq_len,
+        )
+        seq.length = seq_len
+        self.input_ids[row].fill_(1)
+        self.input_ids[row, 0] = self.gpt.start_audio_token
+        return hidden_states[:, -1]
+
+    def _decode(self, sequences):
+        """Feed the last code of the sequences in the first rows and return their new hidden states."""
+        num_codes = torch.tensor([len(seq.codes) for seq in sequences], device=self.device)
+        tokens = self.input_ids[: len(sequences)].gather(1, num_codes.unsqueeze(1))
+        emb = self.model.embeddings(tokens) + self.model.pos_embedding.emb(num_codes).unsqueeze(1)
+        positions = torch.tensor([[seq.length] for seq in sequences], device=self.device)
+        length = max(seq.length for seq in sequences) + 1
+        attention_mask = (torch.arange(length, device=self.device) <= positions)[:, None, None, :]
+        hidden_states = gpt2_cached_forward(
+            self.model.transformer,
+            emb,
+            self.cache,
+            positions,
+            attention_mask,
+            rows=slice(0, len(sequences)),
+            length=length,
+        )
+        for seq in sequences:
+            seq.length += 1
+        return hidden_states[:, -1]
+
+    def _retire(self, row):
+        """Remove the sequence of `row`, moving the last running sequence into its slot."""
+        last = len(self.running) - 1
+        if row != last:
+            self.cache.copy_row(last, row, length=self.running[last].length)
+            self.input_ids[row] = self.input_ids[last]
+            self.running[row] = self.running[last]
+        self.running.pop()
+
+    @torch.inference_mode()
+    def step(self):
+        """Admit waiting requests, decode one code for every running sequence and return the finished ones."""
+        hidden_states = []
+        if self.running:
+            hidden_states.append(self._decode(self.running))
+        while self.waiting and len(self.running) < self.max_batch_size:
+            seq = self.waiting.popleft()
+            self.running.append(seq)
+            hidden_states.append(self._prefill(seq, len(self.running) - 1))
+        if not hidden_states:
+            return []
+
+        latents = self.model.final_norm(torch.cat(hidden_states, dim=0))
+        logits = self.model.lm_head[-1](latents)
+        batch_size = len(self.running)
+        scores = self.logits_processor(self.input_ids[:batch_size], logits)
+        if self.do_sample:
+            next_tokens = torch.multinomial(torch.softmax(scores, dim=-1), num_samples=1).squeeze(1)
+        else:
+            next_tokens = torch.argmax(scores, dim=-1)
+        num_codes = torch.tensor([len(seq.codes) for seq in self.running], device=self.device)
+        self.input_ids[torch.arange(batch_size, device=self.device), num_codes + 1] = next_tokens
+
+        finished_rows = []
+        for row, (seq, token) in enumerate(zip(self.running, next_tokens.tolist())):
+            seq.codes.append(token)
+            seq.latents.append(latents[row])
+            if token == self.gpt.stop_audio_token or len(seq.codes) >= self.gpt.max_gen_mel_tokens:
+                finished_rows.append(row)
+
+        finished = []
+        for row in reversed(finished_rows):
+            seq = self.running[row]
+            finished.append(
+                GenerationResult(
+                    request_id=seq.request_id,
+                    codes=torch.tensor([seq.codes], device=self.device),
+                    latents=torch.stack(seq.latents).unsqueeze(0),
+                )
+            )
+            self._retire(row)
+        return finished
+
+    def run(self):
+        """Decode until no request is left, yielding the results as they finish.
+
+        Requests added while iterating join the running batch at the next step.
+        """
+        while self.waiting or self.running:
+            yield from self.step()
@@ -346,9 +346,13 @@ class SELayer(nn.Module):
             nn.Sigmoid(),
         )
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        """mask: (b, 1, 1, t) float mask of the valid frames of padded batches, whose padded frames are zero."""
         b, c, _, _ = x.size()
-        y = self.avg_pool(x).view(b, c)
+        if mask is None:
+            y = self.avg_pool(x).view(b, c)
+        else:
+            y = x.sum(dim=(2, 3)) / (mask.sum(dim=(2, 3)) * x.size(2))
         y = self.fc(y).view(b, c, 1, 1)
         return x * y
 
@@ -367,22 +371,30 @@ class SEBasicBlock(nn.Module):
         self.downsample = downsample
         self.stride = stride
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        """mask: (b, 1, 1, t) float mask of the valid output frames. The padded frames of `x` must be zero, and are
+        kept to zero in the output so the convolutions see the same zero padding as unpadded inputs."""
         residual = x
 
         out = self.conv1(x)
         out = self.relu(out)
         out = self.bn1(out)
+        if mask is not None:
+            out = out * mask
 
         out = self.conv2(out)
         out = self.bn2(out)
-        out = self.se(out)
+        if mask is not None:
+            out = out * mask
+        out = self.se(out, mask=mask)
 
         if self.downsample is not None:
             residual = self.downsample(x)
 
         out += residual
         out = self.relu(out)
+        if mask is not None:
+            out = out * mask
         return out
 
 
@@ -521,17 +533,21 @@ class ResNetSpeakerEncoder(nn.Module):
         nn.init.xavier_normal_(out)
         return out
 
-    def forward(self, x, l2_norm=False):
+    def forward(self, x, l2_norm=False, lengths=None):
         """Forward pass of the model.
 
         Args:
             x (Tensor): Raw waveform signal or spectrogram frames. If input is a waveform, `torch_spec` must be `True`
                 to compute the spectrogram on-the-fly.
             l2_norm (bool): Whether to L2-normalize the outputs.
+            lengths (Tensor, optional): Valid lengths (samples or frames) of the rows of a padded batch. Each row gets
+                the embedding it would get alone. Defaults to None.
 
         Shapes:
             - x: :math:`(N, 1, T_{in})` or :math:`(N, D_{spec}, T_{in})`
         """
+        if lengths is not None:
+            return self.masked_forward(x, lengths, l2_norm=l2_norm)
         x.squeeze_(1)
         # if you torch spec compute it otherwise use the mel spec computed by the AP
         if self.use_torch_spec:
@@ -568,6 +584,63 @@ class ResNetSpeakerEncoder(nn.Module):
             x = torch.nn.functional.normalize(x, p=2, dim=1)
         return x
 
+    def masked_forward(self, x, lengths, l2_norm=False):
+        """Forward pass of a padded batch, see `forward()`.
+
+        The padded frames are kept to zero between the layers and left out of the normalization, squeeze-excitation
+        and attentive pooling statistics.
+        """
+        x = x.squeeze(1)
+        lengths = lengths.to(x.device)
+        if self.use_torch_spec:
+            # each row on its own so the reflect padding of the STFT matches the unpadded signal
+            specs = [self.torch_spec(x[i : i + 1, : int(length)])[0] for i, length in enumerate(lengths)]
+            lengths = torch.tensor([spec.shape[-1] for spec in specs], device=x.device)
+            x = torch.nn.utils.rnn.pad_sequence([spec.transpose(0, 1) for spec in specs], batch_first=True)
+            x = x.transpose(1, 2)
+
+        mask = (torch.arange(x.shape[-1], device=x.device)[None, :] < lengths[:, None]).to(x.dtype)[:, None, :]
+        if self.log_input:
+            x = (x + 1e-6).log()
+        count = mask.sum(dim=-1, keepdim=True)
+        mean = (x * mask).sum(dim=-1, keepdim=True) / count
+        var = (((x - mean) * mask) ** 2).sum(dim=-1, keepdim=True) / count
+        x = ((x - mean) / torch.sqrt(var + self.instancenorm.eps) * mask).unsqueeze(1)
+        mask = mask.unsqueeze(1)
+
+        x = self.conv1(x)
+        x = self.relu(x)
+        x = self.bn1(x) * mask
+
+        for layer in (self.layer1, self.layer2, self.layer3, self.layer4):
+            for block in layer:
+                if block.stride != 1:
+                    # strided 3x3 convolutions with padding 1 keep ceil(t / 2) frames
+                    lengths = (lengths - 1) // 2 + 1
+                    frames = (x.shape[-1] - 1) // 2 + 1
+                    mask = (torch.arange(frames, device=x.device) < lengths[:, None]).to(x.dtype)[:, None, None, :]
+                x = block(x, mask=mask)
+
+        x = x.reshape(x.size()[0], -1, x.size()[-1])
+        mask = mask.squeeze(1)
+
+        w = self.attention[:-1](x).masked_fill(mask == 0, -torch.inf)
+        w = self.attention[-1](w)
+
+        if self.encoder_type == "SAP":
+            x = torch.sum(x * w, dim=2)
+        elif self.encoder_type == "ASP":
+            mu = torch.sum(x * w, dim=2)
+            sg = torch.sqrt((torch.sum((x**2) * w, dim=2) - mu**2).clamp(min=1e-5))
+            x = torch.cat((mu, sg), 1)
+
+        x = x.view(x.size()[0], -1)
+        x = self.fc(x)
+
+        if l2_norm:
+            x = torch.nn.functional.normalize(x, p=2, dim=1)
+        return x
+
     def load_checkpoint(
         self,
         checkpoint_path: str,
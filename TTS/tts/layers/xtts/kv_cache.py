@@ -0,0 +1,92 @@
+import torch
+import torch.nn.functional as F
+
+
+class StaticKVCache:
+    """Preallocated key/value cache for the GPT-2 stack of XTTS.
+
+    The keys and values of each layer live in `(batch_size, heads, max_len, head_dim)` buffers that are written in
+    place, instead of HuggingFace's tuple `past_key_values` that is concatenated (and reallocated) at every step.
+    Each row is an independent sequence with its own write positions.
+    """
+
+    def __init__(self, num_layers, batch_size, num_heads, max_len, head_dim, device=None, dtype=None):
+        shape = (batch_size, num_heads, max_len, head_dim)
+        self.keys = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(num_layers)]
+        self.values = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(num_layers)]
+        self.batch_size = batch_size
+        self.max_len = max_len
+
+    @classmethod
+    def from_gpt2(cls, transformer, batch_size, max_len):
+        """Create a cache matching the layers, heads, device and dtype of a HuggingFace `GPT2Model`."""
+        config = transformer.config
+        param = next(transformer.parameters())
+        return cls(
+            config.n_layer,
+            batch_size,
+            config.n_head,
+            max_len,
+            config.n_embd // config.n_head,
+            device=param.device,
+            dtype=param.dtype,
+        )
+
+    def update(self, layer, key, value, positions, rows=slice(None), length=None):
+        """Write `key` and `value` (b, heads, q, head_dim) of `rows` at `positions` (b, q).
+
+        Returns views of the cached keys and values of `rows`, limited to the first `length` positions if given.
+        """
+        keys = self.keys[layer][rows]
+        values = self.values[layer][rows]
+        batch_index = torch.arange(keys.shape[0], device=keys.device).unsqueeze(1)
+        keys[batch_index, :, positions] = key.transpose(1, 2)
+        values[batch_index, :, positions] = value.transpose(1, 2)
+        if length is not None:
+            return keys[:, :, :length], values[:, :, :length]
+        return keys, values
+
+    def copy_row(self, src, dst, length=None):
+        """Copy the cached sequence of row `src` into row `dst`, limited to the first `length` positions if given."""
+        length = self.max_len if length is None else length
+        for keys, values in zip(self.keys, self.values):
+            keys[dst, :, :length] = keys[src, :, :length]
+            values[dst, :, :length] = values[src, :, :length]
+
+    def reorder_cache(self, index):
+        """Reorder the rows in place following `index`, e.g. the beam indices of a beam search step."""
+        for keys, values in zip(self.keys, self.values):
+            keys.copy_(keys.index_select(0, index.to(keys.device)))
+            values.copy_(values.index_select(0, index.to(values.device)))
+
+
+def gpt2_cached_forward(transformer, inputs_embeds, cache, positions, attention_mask, rows=slice(None), length=None):
+    """Run the blocks of a HuggingFace `GPT2Model` reading and writing a `StaticKVCache`.
+
+    Args:
+        transformer (GPT2Model): GPT-2 stack in eval mode. XTTS adds its own position embeddings to the inputs.
+        inputs_embeds (Tensor): input embeddings (b, q, d).
+        cache (StaticKVCache): cache the keys and values are written to.
+        positions (Tensor): cache positions of the inputs (b, q).
+        attention_mask (Tensor): boolean mask (b, 1, q, length) of the cached positions each input attends to.
+        rows (slice): cache rows of the batch.
+        length (int): number of cached positions to attend over. Defaults to the whole cache.
+
+    Returns:
+        Tensor: hidden states after the final layer norm of the stack (b, q, d).
+    """
+    hidden_states = inputs_embeds
+    batch_size, seq_len, _ = hidden_states.shape
+    for layer, block in enumerate(transformer.h):
+        attn = block.attn
+        residual = hidden_states
+        query, key, value = attn.c_attn(block.ln_1(hidden_states)).split(attn.split_size, dim=2)
+        query, key, value = (
+            x.view(batch_size, seq_len, attn.num_heads, attn.head_dim).transpose(1, 2) for x in (query, key, value)
+        )
+        keys, values = cache.update(layer, key, value, positions, rows=rows, length=length)
+        attn_output = F.scaled_dot_product_attention(query, keys, values, attn_mask=attention_mask)
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size, seq_len, -1)
+        hidden_states = residual + attn.c_proj(attn_output)
+        hidden_states = hidden_states + block.mlp(block.ln_2(hidden_states))
+    return transformer.ln_f(hidden_states)
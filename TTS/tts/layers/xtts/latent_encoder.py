@@ -8,8 +8,23 @@ from torch.nn import functional as F
 
 
 class GroupNorm32(nn.GroupNorm):
-    def forward(self, x):
-        return super().forward(x.float()).type(x.dtype)
+    def forward(self, x, mask=None):
+        """
+        x: (b, c, t)
+        mask: (b, t) bool of the valid frames. The statistics are computed over the valid frames only.
+        """
+        if mask is None:
+            return super().forward(x.float()).type(x.dtype)
+        b, c, t = x.shape
+        h = x.float().reshape(b, self.num_groups, -1, t)
+        m = mask[:, None, None, :].float()
+        count = m.sum(dim=(2, 3), keepdim=True) * h.shape[2]
+        mean = (h * m).sum(dim=(2, 3), keepdim=True) / count
+        var = ((h - mean) ** 2 * m).sum(dim=(2, 3), keepdim=True) / count
+        h = ((h - mean) / torch.sqrt(var + self.eps)).reshape(b, c, t)
+        if self.affine:
+            h = h * self.weight[None, :, None] + self.bias[None, :, None]
+        return h.type(x.dtype)
 
 
 def conv_nd(dims, *args, **kwargs):
@@ -60,7 +75,7 @@ class QKVAttention(nn.Module):
         weight = torch.einsum("bct,bcs->bts", q * scale, k * scale)  # More stable with f16 than dividing afterwards
         weight = weight + qk_bias
         if mask is not None:
-            mask = mask.repeat(self.n_heads, 1, 1)
+            mask = mask.repeat_interleave(self.n_heads, 0)
             weight[mask.logical_not()] = -torch.inf
         weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
         a = torch.einsum("bts,bcs->bct", weight, v)
@@ -97,16 +112,25 @@ class AttentionBlock(nn.Module):
         self.x_proj = nn.Identity() if out_channels == channels else conv_nd(1, channels, out_channels, 1)
         self.proj_out = zero_module(conv_nd(1, out_channels, out_channels, 1))
 
-    def forward(self, x, mask=None, qk_bias=0):
+    def forward(self, x, mask=None, qk_bias=0, padding_mask=None):
+        """
+        x: (b, c, t)
+        mask: (t, t) or (b, t, t) attention mask.
+        padding_mask: (b, t) bool of the valid frames of padded batches. Padded frames are left out of the
+            normalization statistics and are not attended to.
+        """
         b, c, *spatial = x.shape
         if mask is not None:
             if len(mask.shape) == 2:
                 mask = mask.unsqueeze(0).repeat(x.shape[0], 1, 1)
             if mask.shape[1] != x.shape[-1]:
                 mask = mask[:, : x.shape[-1], : x.shape[-1]]
+        if padding_mask is not None:
+            key_mask = padding_mask[:, None, :].expand(-1, padding_mask.shape[-1], -1)
+            mask = key_mask if mask is None else mask & key_mask
 
         x = x.reshape(b, c, -1)
-        x = self.norm(x)
+        x = self.norm(x, mask=padding_mask)
         if self.do_activation:
             x = F.silu(x, inplace=True)
         qkv = self.qkv(x)
@@ -132,10 +156,14 @@ class ConditioningEncoder(nn.Module):
         self.attn = nn.Sequential(*attn)
         self.dim = embedding_dim
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         """
         x: (b, 80, s)
+        mask: (b, s) bool of the valid frames when `x` is a padded batch.
         """
         h = self.init(x)
-        h = self.attn(h)
+        if mask is None:
+            return self.attn(h)
+        for block in self.attn:
+            h = block(h, padding_mask=mask)
         return h
@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def hash_file(path, block_size=1 << 20):
+    """SHA-256 of the content of the file at `path`."""
+    hash_func = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            hash_func.update(block)
+    return hash_func.hexdigest()
+
+
+class SpeakerLatentCache:
+    """Cache of the conditioning latents of reference voices.
+
+    Entries are keyed on the content hash of the reference audio files and the conditioning parameters, so renaming or
+    copying a file still hits the cache while editing it does not. Two tiers are used:
+
+    - an in-memory LRU of at most `max_items` entries.
+    - an optional on-disk tier in `cache_dir`, one `<key>.pth` file per entry, that survives restarts. Entries depend
+      on the model weights, so the model passes its own fingerprint as part of the key (see `Xtts.speaker_cache`).
+
+    Args:
+        max_items (int): Maximum number of entries kept in memory. Defaults to 128.
+        cache_dir (str, optional): Directory of the on-disk tier. If None, only the memory tier is used.
+    """
+
+    def __init__(self, max_items=128, cache_dir=None):
+        self.max_items = max_items
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._memory = OrderedDict()
+        # content hashes of the files already seen, keyed on (path, size, mtime) to avoid reading them again
+        self._file_hashes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __contains__(self, key):
+        return key in self._memory or (self.cache_dir is not None and os.path.isfile(self._path(key)))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pth")
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        file_hash = self._file_hashes.get(file_id)
+        if file_hash is None:
+            file_hash = hash_file(path)
+            self._file_hashes[file_id] = file_hash
+        return file_hash
+
+    def make_key(self, audio_paths, **params):
+        """Key of the reference `audio_paths` (in order) conditioned with `params`."""
+        key = {"audio": [self.file_hash(path) for path in audio_paths], "params": params}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached `(gpt_cond_latent, speaker_embedding)` of `key` on CPU, or None."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if self.cache_dir is None or not os.path.isfile(self._path(key)):
+            return None
+        try:
+            entry = torch.load(self._path(key), map_location="cpu")
+        except (OSError, RuntimeError, EOFError):
+            # truncated or corrupted file, it is overwritten by the next `put()`
+            return None
+        value = (entry["gpt_cond_latent"], entry["speaker_embedding"])
+        self._remember(key, value)
+        return value
+
+    def put(self, key, gpt_cond_latent, speaker_embedding):
+        """Store the latents of `key` in both tiers."""
+        value = (gpt_cond_latent.detach().cpu(), speaker_embedding.detach().cpu())
+        self._remember(key, value)
+        if self.cache_dir is not None:
+            # write then rename so concurrent readers never see a partial file
+            tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            torch.save({"gpt_cond_latent": value[0], "speaker_embedding": value[1]}, tmp_path)
+            os.replace(tmp_path, self._path(key))
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def clear(self, disk=False):
+        """Empty the memory tier, and the on-disk tier if `disk`."""
+        with self._lock:
+            self._memory.clear()
+        if disk and self.cache_dir is not None:
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith(".pth"):
+                    os.remove(os.path.join(self.cache_dir, file_name))
@@ -0,0 +1,194 @@
+import math
+import time
+from dataclasses import dataclass
+
+import torch
+
+
+def interpolate_window(x, start, scale_factor):
+    """Linear interpolation of a window of a longer sequence, on the grid of the whole sequence.
+
+    Interpolating a window on its own shifts the output grid unless the window starts on a multiple of the grid
+    period, e.g. 147 frames for 22050 -> 24000 Hz. This computes instead the frames of
+    `F.interpolate(sequence, scale_factor=scale_factor, mode="linear")` whose source falls in the window.
+
+    Args:
+        x (Tensor): frames `[start, start + n)` of the sequence (b, c, n).
+        start (int): position of the window in the sequence.
+        scale_factor (float): interpolation factor.
+
+    Returns:
+        Tuple[Tensor, int]: interpolated frames (b, c, m) and their position in the interpolated sequence.
+    """
+    n = x.shape[-1]
+    # first output frame whose source does not need the frame before the window, the sources are clamped to 0
+    y_start = math.ceil((start + 0.5) * scale_factor - 0.5) if start > 0 else 0
+    y_end = math.floor((start + n) * scale_factor)
+    positions = torch.arange(y_start, y_end, device=x.device, dtype=torch.float64)
+    positions = (((positions + 0.5) / scale_factor - 0.5).clamp(min=0) - start).clamp(0, n - 1)
+    index = positions.floor().long()
+    weight = (positions - index).to(x.dtype)
+    next_index = (index + 1).clamp(max=n - 1)
+    return x[..., index] * (1 - weight) + x[..., next_index] * weight, y_start
+
+
+@dataclass
+class StreamMetrics:
+    """Latency metrics of an `Xtts.inference_stream()` call, filled in while the stream is consumed.
+
+    Args:
+        time_to_first_audio (float): Seconds from the call to the first audio chunk.
+        processing_time (float): Seconds spent producing the chunks, excluding the time the consumer holds the
+            generator.
+        audio_duration (float): Seconds of audio streamed so far.
+        num_chunks (int): Number of chunks streamed so far.
+    """
+
+    time_to_first_audio: float = None
+    processing_time: float = 0.0
+    audio_duration: float = 0.0
+    num_chunks: int = 0
+
+    @property
+    def rtf(self):
+        """Real-time factor: processing time over audio duration. Below 1 the stream is faster than real time."""
+        return self.processing_time / self.audio_duration if self.audio_duration > 0 else None
+
+    def add_chunk(self, num_samples, sample_rate, start_time, elapsed):
+        if self.time_to_first_audio is None:
+            self.time_to_first_audio = time.perf_counter() - start_time
+        self.processing_time += elapsed
+        self.audio_duration += num_samples / sample_rate
+        self.num_chunks += 1
+
+
+@dataclass
+class StreamingPolicy:
+    """Chunking policy of `Xtts.inference_stream()`.
+
+    The first chunk is small to get the first audio out quickly, then each chunk is `growth_factor` times larger than
+    the previous one, up to `max_chunk_size` tokens, so the later chunks spend less time in the vocoder context. The
+    cross-fade held back from each chunk is `overlap_ratio` of its audio, up to `max_overlap_len` samples, so a short
+    chunk is not mostly held back.
+
+    Args:
+        first_chunk_size (int): Number of GPT tokens of the first chunk. Defaults to 4.
+        growth_factor (float): Size ratio between consecutive chunks. Defaults to 2.0.
+        max_chunk_size (int): Maximum number of GPT tokens of a chunk. Defaults to 40.
+        max_overlap_len (int): Maximum number of samples cross-faded between chunks. Defaults to 1024.
+        overlap_ratio (float): Maximum fraction of the audio of a chunk held back for the cross-fade. Defaults to 0.25.
+    """
+
+    first_chunk_size: int = 4
+    growth_factor: float = 2.0
+    max_chunk_size: int = 40
+    max_overlap_len: int = 1024
+    overlap_ratio: float = 0.25
+
+    @classmethod
+    def fixed(cls, chunk_size, overlap_len=1024):
+        """Policy of chunks of `chunk_size` tokens cross-faded over `overlap_len` samples."""
+        return cls(
+            first_chunk_size=chunk_size,
+            growth_factor=1.0,
+            max_chunk_size=chunk_size,
+            max_overlap_len=overlap_len,
+            overlap_ratio=1.0,
+        )
+
+    def chunk_size(self, chunk_index):
+        """Number of tokens of the chunk `chunk_index`. Non-positive sizes stream the whole sentence in one chunk."""
+        if self.growth_factor > 1.0:
+            if not 0 < self.first_chunk_size < self.max_chunk_size:
+                return min(self.first_chunk_size, self.max_chunk_size)
+            # stop growing once the cap is reached, the power overflows on long streams
+            max_index = math.ceil(math.log(self.max_chunk_size / self.first_chunk_size, self.growth_factor))
+            chunk_index = min(chunk_index, max_index)
+        return min(round(self.first_chunk_size * self.growth_factor**chunk_index), self.max_chunk_size)
+
+
+class StreamingVocoder:
+    """Incremental HiFi-GAN vocoding of the GPT latents of a stream.
+
+    Each chunk vocodes its new latents together with the last `context_len` latents already vocoded, instead of the
+    whole history, so every chunk costs the same whatever the length of the utterance. The audio of the context is
+    dropped, except for the last `overlap_len` samples that are cross-faded with the tail kept from the previous chunk.
+
+    Args:
+        decoder (HifiDecoder): vocoder.
+        speaker_embedding (Tensor): speaker embedding (1, 512, 1).
+        context_len (int): Number of previous latents vocoded as left context. If None, the whole history is vocoded.
+            Defaults to 24.
+        overlap_len (int): Maximum number of samples cross-faded between chunks. Defaults to 1024.
+        length_scale (float): Latent interpolation factor, see `speed` in `Xtts.inference()`. Defaults to 1.0.
+        overlap_ratio (float): Maximum fraction of the new audio of a chunk held back for the cross-fade. Defaults to
+            1.0.
+    """
+
+    def __init__(
+        self, decoder, speaker_embedding, context_len=24, overlap_len=1024, length_scale=1.0, overlap_ratio=1.0
+    ):
+        self.decoder = decoder
+        self.speaker_embedding = speaker_embedding
+        self.context_len = context_len
+        self.overlap_len = overlap_len
+        self.overlap_ratio = overlap_ratio
+        self.length_scale = length_scale
+        self.context = None
+        self.wav_overlap = None
+        # number of latents vocoded and sample position of the end of the last vocoded window in the stream
+        self.num_latents = 0
+        self.wav_end = 0
+
+    def __call__(self, latents, is_end=False):
+        """Vocode the new `latents` (1, k, d) and return the next audio chunk.
+
+        The last samples are held back for the cross-fade with the next chunk, unless `is_end`.
+        """
+        if latents.shape[1] == 0:
+            wav_chunk = self.wav_overlap if is_end and self.wav_overlap is not None else latents.new_zeros(0)
+            if is_end:
+                self.wav_overlap = None
+            return wav_chunk
+
+        window = latents if self.context is None else torch.cat([self.context, latents], dim=1)
+        num_context = window.shape[1] - latents.shape[1]
+
+        # same upsampling as `HifiDecoder.forward()` (after the `speed` interpolation), on the grid of the stream
+        z, z_start = window.transpose(1, 2), self.num_latents - num_context
+        if self.length_scale != 1.0:
+            z, z_start = interpolate_window(z, z_start, self.length_scale)
+        z, z_start = interpolate_window(
+            z, z_start, self.decoder.ar_mel_length_compression / self.decoder.output_hop_length
+        )
+        if self.decoder.output_sample_rate != self.decoder.input_sample_rate:
+            z, z_start = interpolate_window(
+                z, z_start, self.decoder.output_sample_rate / self.decoder.input_sample_rate
+            )
+        wav = self.decoder.waveform_decoder(z, g=self.speaker_embedding).reshape(-1)
+
+        # position of the window in the stream, the previous window ended at `wav_end`
+        wav_start = z_start * (wav.shape[0] // z.shape[-1])
+        start = min(max(self.wav_end - wav_start, 0), wav.shape[0])
+        self.num_latents += latents.shape[1]
+        self.wav_end = wav_start + wav.shape[0]
+        overlap = 0 if self.wav_overlap is None else min(self.wav_overlap.shape[0], start)
+        if is_end or self.context_len == 0:
+            # no next chunk to cross-fade with
+            end = wav.shape[0]
+        else:
+            overlap_len = min(self.overlap_len, int((wav.shape[0] - start) * self.overlap_ratio))
+            end = max(wav.shape[0] - overlap_len, start)
+        wav_chunk = wav[start - overlap : end].clone()
+        overlap = min(overlap, wav_chunk.shape[0])
+        if overlap > 0:
+            fade_in = torch.linspace(0.0, 1.0, overlap, device=wav.device)
+            prev = self.wav_overlap[self.wav_overlap.shape[0] - overlap :]
+            wav_chunk[:overlap] = prev * (1.0 - fade_in) + wav_chunk[:overlap] * fade_in
+        self.wav_overlap = None if is_end else wav[end:]
+
+        if self.context_len is None:
+            self.context = window
+        elif self.context_len > 0:
+            self.context = window[:, -self.context_len :]
+        return wav_chunk
@@ -0,0 +1,49 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+import torch
+
+from TTS.tts.models.xtts import load_audio
+
+
+class DecodedAudioCache:
+    """On-disk cache of decoded and resampled training audio.
+
+    Each clip is stored once as a float16 `.npy` file and memory-mapped on later reads, so the decoding and resampling
+    of `load_audio()` run once per clip instead of once per epoch, and the `DataLoader` workers share the clips through
+    the page cache. Entries are keyed on the path, size and modification time of the audio file and the sample rate, so
+    an edited file is decoded again.
+
+    Args:
+        cache_dir (str): Directory of the cache.
+        sample_rate (int): Sample rate of the decoded audio.
+    """
+
+    def __init__(self, cache_dir, sample_rate):
+        self.cache_dir = cache_dir
+        self.sample_rate = sample_rate
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, audio_path):
+        stat = os.stat(audio_path)
+        key = f"{os.path.abspath(audio_path)}:{stat.st_size}:{stat.st_mtime_ns}:{self.sample_rate}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def load(self, audio_path):
+        """Return the audio of `audio_path` (1, t) as `load_audio()` does."""
+        cache_path = self._path(audio_path)
+        if os.path.isfile(cache_path):
+            try:
+                return torch.from_numpy(np.load(cache_path, mmap_mode="r").astype(np.float32))
+            except (OSError, ValueError):
+                # truncated or corrupted file, decode it again
+                pass
+        wav = load_audio(audio_path, self.sample_rate).numpy().astype(np.float16)
+        # write then rename so concurrent workers never read a partial file
+        tmp_path = f"{cache_path[:-4]}.{os.getpid()}.{threading.get_ident()}.tmp.npy"
+        np.save(tmp_path, wav)
+        os.replace(tmp_path, cache_path)
+        # same precision as the cached reads of the next epochs
+        return torch.from_numpy(wav.astype(np.float32))
@@ -0,0 +1,128 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from TTS.tts.models.xtts import load_audio
+
+
+class AudioShardStore:
+    """Training audio packed into a few large shard files, already decoded and resampled.
+
+    The clips are concatenated in `shard_<i>.bin` files and `index.json` holds the shard, offset and length of each clip,
+    keyed by absolute audio path, along with the sample rate and dtype. Clips are read as views of a memory map of
+    their shard, so a read touches only the pages of the clip and never opens the original audio file. The memory maps
+    are opened on first access so the store can be sent to `DataLoader` workers.
+
+    Use `AudioShardStore.pack()` or `pack_audio_shards.py` to create a store.
+
+    Args:
+        path (str): Directory of the store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.sample_rate = index["sample_rate"]
+        self.dtype = np.dtype(index["dtype"])
+        self.shards = index["shards"]
+        self.items = index["items"]
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, audio_path):
+        return os.path.abspath(audio_path) in self.items
+
+    def __getstate__(self):
+        # do not pickle the memory maps, each worker opens its own
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def load(self, audio_path):
+        """Return the audio of `audio_path` (1, t) as `load_audio()` does.
+
+        float32 stores return a view of the shard without copy. The view is copy-on-write, so writing to it never
+        modifies the shard.
+        """
+        shard, offset, length = self.items[os.path.abspath(audio_path)]
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(os.path.join(self.path, self.shards[shard]), dtype=self.dtype, mode="c")
+        wav = torch.from_numpy(self._maps[shard][offset : offset + length])
+        return wav.float().unsqueeze(0)
+
+    def check_sample_rate(self, sample_rate):
+        if self.sample_rate != sample_rate:
+            raise ValueError(
+                f" [!] Audio shards in {self.path} are sampled at {self.sample_rate} Hz, but the dataset expects "
+                f"{sample_rate} Hz."
+            )
+
+    @classmethod
+    def pack(cls, path, samples, sample_rate, shard_size=2**30, dtype="float32", num_workers=8):
+        """Decode the audio files of the `load_tts_samples()` `samples` and pack them in a new store in `path`.
+
+        Clips are decoded with `load_audio()` by `num_workers` threads and appended to the current shard until it
+        exceeds `shard_size` bytes. Reference files (`ref_file`) are packed too. Clips that fail to load are skipped and
+        reported.
+        """
+        os.makedirs(path, exist_ok=True)
+        dtype = np.dtype(dtype)
+        audio_paths = []
+        for sample in samples:
+            for audio_path in (sample["audio_file"], sample.get("ref_file", "null")):
+                if audio_path != "null":
+                    audio_paths.append(os.path.abspath(audio_path))
+        audio_paths = list(dict.fromkeys(audio_paths))
+
+        def _load(audio_path):
+            try:
+                return load_audio(audio_path, sample_rate)
+            except Exception:  # pylint: disable=broad-except
+                return None
+
+        def _load_all(executor):
+            # `map()` keeps the order, so the clips of a metadata file stay contiguous. Blocks of paths bound the number
+            # of decoded clips waiting to be written.
+            block_size = 4 * num_workers
+            for i in range(0, len(audio_paths), block_size):
+                block = audio_paths[i : i + block_size]
+                yield from zip(block, executor.map(_load, block))
+
+        shards = []
+        items = {}
+        failed = []
+        f = None
+        offset = 0
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for audio_path, wav in tqdm(_load_all(executor), total=len(audio_paths)):
+                if wav is None:
+                    failed.append(audio_path)
+                    continue
+                if f is None or offset * dtype.itemsize >= shard_size:
+                    if f is not None:
+                        f.close()
+                    shards.append(f"shard_{len(shards)}.bin")
+                    f = open(os.path.join(path, shards[-1]), "wb")  # pylint: disable=consider-using-with
+                    offset = 0
+                wav = wav.reshape(-1).numpy().astype(dtype)
+                f.write(wav.tobytes())
+                items[audio_path] = [len(shards) - 1, offset, len(wav)]
+                offset += len(wav)
+        if f is not None:
+            f.close()
+
+        index = {"sample_rate": sample_rate, "dtype": dtype.name, "shards": shards, "items": items}
+        # written last, a store without index is an interrupted packing
+        with open(os.path.join(path, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        print(f" > {len(items)} clips packed in {len(shards)} shards in {path}")
+        if failed:
+            print(f" > {len(failed)} clips could not be loaded, e.g. {failed[0]}")
+        return cls(path)
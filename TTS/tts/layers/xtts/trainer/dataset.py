@@ -6,6 +6,10 @@ import torch
 import torch.nn.functional as F
 import torch.utils.data
 
+from TTS.tts.layers.xtts.trainer.audio_cache import DecodedAudioCache
+from TTS.tts.layers.xtts.trainer.audio_shards import AudioShardStore
+from TTS.tts.layers.xtts.trainer.dvae_codes import DVAECodeStore
+from TTS.tts.layers.xtts.trainer.sample_manifest import SampleManifest
 from TTS.tts.models.xtts import load_audio
 
 torch.set_num_threads(1)
@@ -23,9 +27,16 @@ def key_samples_by_col(samples, col):
     return samples_by_col
 
 
-def get_prompt_slice(gt_path, max_sample_length, min_sample_length, sample_rate, is_eval=False, ref_path="null"):
+def get_prompt_slice(
+    gt_path, max_sample_length, min_sample_length, sample_rate, is_eval=False, ref_path="null", rel_clip=None
+):
+    """Cut the conditioning clip from `gt_path`, or from `ref_path` if it is not "null".
+
+    `rel_clip` is the already loaded audio of that file, if given it is not loaded again.
+    """
     if ref_path == "null":
-        rel_clip = load_audio(gt_path, sample_rate)
+        if rel_clip is None:
+            rel_clip = load_audio(gt_path, sample_rate)
         # if eval uses a middle size sample when it is possible to be more reproducible
         if is_eval:
             sample_length = int((min_sample_length + max_sample_length) / 2)
@@ -48,7 +59,8 @@ def get_prompt_slice(gt_path, max_sample_length, min_sample_length, sample_rate,
         cond_idxs = [rand_start, rand_end]
         return rel_clip, rel_clip.shape[-1], cond_idxs
     else:
-        rel_clip = load_audio(ref_path, sample_rate)
+        if rel_clip is None:
+            rel_clip = load_audio(ref_path, sample_rate)
 
         sample_length = min(max_sample_length, rel_clip.shape[-1])
 
@@ -74,9 +86,33 @@ class XTTSDataset(torch.utils.data.Dataset):
         self.max_wav_len = model_args.max_wav_length
         self.max_text_len = model_args.max_text_length
         self.use_masking_gt_prompt_approach = model_args.gpt_use_masking_gt_prompt_approach
+        self.code_stride_len = model_args.gpt_code_stride_len
         assert self.max_wav_len is not None and self.max_text_len is not None
 
+        # packed audio shards, read instead of the audio files
+        self.audio_shards = None
+        if getattr(model_args, "audio_shards_path", None):
+            self.audio_shards = AudioShardStore(model_args.audio_shards_path)
+            self.audio_shards.check_sample_rate(sample_rate)
+        self.audio_cache = None
+        if getattr(model_args, "audio_cache_dir", None):
+            self.audio_cache = DecodedAudioCache(model_args.audio_cache_dir, sample_rate)
+        # sample lengths read from the file headers, saved across runs if a path is given
+        self.manifest = SampleManifest(
+            getattr(model_args, "sample_manifest_path", None) or None, SampleManifest.tokenizer_id(tokenizer)
+        )
+
         self.samples = samples
+        # precomputed DVAE codes, served instead of the waves so the trainer skips the DVAE
+        self.dvae_codes = None
+        if getattr(model_args, "dvae_codes_path", None):
+            self.dvae_codes = DVAECodeStore(model_args.dvae_codes_path)
+            self.dvae_codes.check_audio_config(sample_rate, config.audio.dvae_sample_rate)
+            self.samples = [sample for sample in samples if sample["audio_file"] in self.dvae_codes]
+            if len(self.samples) < len(samples):
+                print(f" > {len(samples) - len(self.samples)} samples without DVAE codes ignored!")
+        # drop the samples out of the length limits before training instead of when they are drawn
+        self.filter_samples()
         if not is_eval:
             random.seed(config.training_seed)
             # random.shuffle(self.samples)
@@ -84,28 +120,47 @@ class XTTSDataset(torch.utils.data.Dataset):
             # order by language
             self.samples = key_samples_by_col(self.samples, "language")
             print(" > Sampling by language:", self.samples.keys())
-        else:
-            # for evaluation load and check samples that are corrupted to ensures the reproducibility
-            self.check_eval_samples()
-
-    def check_eval_samples(self):
-        print(" > Filtering invalid eval samples!!")
+            # (language, index) of the sample of each dataset index, used when a batch sampler picks the samples
+            self.sample_index = [
+                (lang, idx) for lang, lang_samples in self.samples.items() for idx in range(len(lang_samples))
+            ]
+        # if False, `__getitem__` ignores the index of training samples and draws a random language and sample
+        self.use_sampler_index = False
+
+    def filter_samples(self):
+        """Drop the samples that cannot be read or are out of the length limits, from the manifest lengths.
+
+        Only the audio headers are read, in parallel, and the lengths are cached in the manifest.
+        """
+        print(f" > Filtering invalid {'eval' if self.is_eval else 'train'} samples!!")
+        audio_paths = [
+            sample["audio_file"]
+            for sample in self.samples
+            if self.audio_shards is None or sample["audio_file"] not in self.audio_shards
+        ]
+        failed = self.manifest.update(audio_paths)
         new_samples = []
+        # (audio file, text, language) -> (audio length, text length) of the valid samples
+        self.lengths = {}
         for sample in self.samples:
-            try:
-                tseq, _, wav, _, _, _ = self.load_item(sample)
-            except:
+            text = str(sample["text"])
+            if len(text.strip()) == 0 or os.path.abspath(sample["audio_file"]) in failed:
                 continue
-            # Basically, this audio file is nonexistent or too long to be supported by the dataset.
+            wav_length = self.get_audio_length(sample["audio_file"])
+            text_length = self.manifest.text_length(text, sample["language"], self.get_text)
+            # Ultra short clips are also useless (and can cause problems within some models).
             if (
-                wav is None
-                or (self.max_wav_len is not None and wav.shape[-1] > self.max_wav_len)
-                or (self.max_text_len is not None and tseq.shape[0] > self.max_text_len)
+                text_length is None
+                or text_length > self.max_text_len
+                or wav_length < 0.2 * self.sample_rate
+                or wav_length > self.max_wav_len
             ):
                 continue
+            self.lengths[(sample["audio_file"], text, sample["language"])] = (wav_length, text_length)
             new_samples.append(sample)
+        self.manifest.save()
+        print(f" > Total samples after filtering: {len(new_samples)} of {len(self.samples)}")
         self.samples = new_samples
-        print(" > Total eval samples after filtering:", len(self.samples))
 
     def get_text(self, text, lang):
         tokens = self.tokenizer.encode(text, lang)
@@ -115,21 +170,62 @@ class XTTSDataset(torch.utils.data.Dataset):
         assert not torch.any(tokens == 0), f"Stop token found in {text}"
         return tokens
 
+    def get_audio_length(self, audiopath):
+        """Number of samples of `audiopath` at the dataset sample rate, read from the file header."""
+        if self.audio_shards is not None and audiopath in self.audio_shards:
+            return self.audio_shards.items[os.path.abspath(audiopath)][2]
+        return self.manifest.num_samples(audiopath, self.sample_rate)
+
+    def get_lengths(self):
+        """Audio and text lengths and language of each dataset index, for the length-bucketed batch sampler."""
+        wav_lengths, text_lengths, languages = [], [], []
+        for lang, idx in self.sample_index:
+            sample = self.samples[lang][idx]
+            wav_length, text_length = self.lengths[(sample["audio_file"], str(sample["text"]), sample["language"])]
+            wav_lengths.append(wav_length)
+            text_lengths.append(text_length)
+            languages.append(lang)
+        return wav_lengths, text_lengths, languages
+
+    def get_retry_index(self, index):
+        """Index of the sample loaded instead of the invalid sample `index`.
+
+        Eval takes the next sample so the eval loss is reproducible, training a random one.
+        """
+        if self.is_eval:
+            return (index + 1) % len(self)
+        return random.randrange(len(self))
+
+    def load_wav(self, audiopath):
+        if self.audio_shards is not None and audiopath in self.audio_shards:
+            return self.audio_shards.load(audiopath)
+        if self.audio_cache is not None:
+            return self.audio_cache.load(audiopath)
+        return load_audio(audiopath, self.sample_rate)
+
     def load_item(self, sample):
         text = str(sample["text"])
         tseq = self.get_text(text, sample["language"])
         audiopath = sample["audio_file"]
-        wav = load_audio(audiopath, self.sample_rate)
+        wav = self.load_wav(audiopath)
         if text is None or len(text.strip()) == 0:
             raise ValueError
         if wav is None or wav.shape[-1] < (0.2 * self.sample_rate):
             # Ultra short clips are also useless (and can cause problems within some models).
             raise ValueError
 
+        # the prompt is cut from the target wav unless it comes from another file
+        ref_file = sample["ref_file"]
         if self.use_masking_gt_prompt_approach:
             # get a slice from GT to condition the model
             cond, _, cond_idxs = get_prompt_slice(
-                audiopath, self.max_conditioning_length, self.min_conditioning_length, self.sample_rate, self.is_eval, sample["ref_file"]
+                audiopath,
+                self.max_conditioning_length,
+                self.min_conditioning_length,
+                self.sample_rate,
+                self.is_eval,
+                ref_file,
+                rel_clip=wav if ref_file == "null" else self.load_wav(ref_file),
             )
             # if use masking do not use cond_len
             cond_len = torch.nan
@@ -139,8 +235,18 @@ class XTTSDataset(torch.utils.data.Dataset):
                 if "reference_path" in sample and sample["reference_path"] is not None
                 else audiopath
             )
+            if ref_file != "null":
+                rel_clip = self.load_wav(ref_file)
+            else:
+                rel_clip = wav if ref_sample == audiopath else self.load_wav(ref_sample)
             cond, cond_len, _ = get_prompt_slice(
-                ref_sample, self.max_conditioning_length, self.min_conditioning_length, self.sample_rate, self.is_eval, sample["ref_file"]
+                ref_sample,
+                self.max_conditioning_length,
+                self.min_conditioning_length,
+                self.sample_rate,
+                self.is_eval,
+                ref_file,
+                rel_clip=rel_clip,
             )
             # if do not use masking use cond_len
             cond_idxs = torch.nan
@@ -151,6 +257,10 @@ class XTTSDataset(torch.utils.data.Dataset):
         if self.is_eval:
             sample = self.samples[index]
             sample_id = str(index)
+        elif self.use_sampler_index:
+            lang, index = self.sample_index[index]
+            sample = self.samples[lang][index]
+            sample_id = lang + "_" + str(index)
         else:
             # select a random language
             lang = random.choice(list(self.samples.keys()))
@@ -165,7 +275,7 @@ class XTTSDataset(torch.utils.data.Dataset):
             if self.debug_failures:
                 print(f"Ignoring sample {sample['audio_file']} because it was already ignored before !!")
             # call get item again to get other sample
-            return self[1]
+            return self[self.get_retry_index(index)]
 
         # try to load the sample, if fails added it to the failed samples list
         try:
@@ -174,7 +284,7 @@ class XTTSDataset(torch.utils.data.Dataset):
             if self.debug_failures:
                 print(f"error loading {sample['audio_file']} {sys.exc_info()}")
             self.failed_samples.add(sample_id)
-            return self[1]
+            return self[self.get_retry_index(index)]
 
         # check if the audio and text size limits and if it out of the limits, added it failed_samples
         if (
@@ -189,7 +299,7 @@ class XTTSDataset(torch.utils.data.Dataset):
                     f"error loading {sample['audio_file']}: ranges are out of bounds; {wav.shape[-1]}, {tseq.shape[0]}"
                 )
             self.failed_samples.add(sample_id)
-            return self[1]
+            return self[self.get_retry_index(index)]
 
         res = {
             # 'real_text': text,
@@ -204,6 +314,8 @@ class XTTSDataset(torch.utils.data.Dataset):
             else torch.tensor([cond_len]),
             "cond_idxs": torch.tensor(cond_idxs) if cond_idxs is not torch.nan else torch.tensor([cond_idxs]),
         }
+        if self.dvae_codes is not None:
+            res["audio_codes"] = self.dvae_codes[audiopath]
         return res
 
     def __len__(self):
@@ -213,8 +325,6 @@ class XTTSDataset(torch.utils.data.Dataset):
 
     def collate_fn(self, batch):
         # convert list of dicts to dict of lists
-        B = len(batch)
-
         batch = {k: [dic[k] for dic in batch] for k in batch[0]}
 
         # stack for features that already have the same shape
@@ -223,6 +333,10 @@ class XTTSDataset(torch.utils.data.Dataset):
         batch["conditioning"] = torch.stack(batch["conditioning"])
         batch["cond_lens"] = torch.stack(batch["cond_lens"])
         batch["cond_idxs"] = torch.stack(batch["cond_idxs"])
+        # unpadded text and audio tokens, counted on the host for the throughput logging
+        batch["num_tokens"] = int(
+            batch["text_lengths"].sum() + torch.ceil(batch["wav_lengths"] / self.code_stride_len).sum()
+        )
 
         if torch.any(batch["cond_idxs"].isnan()):
             batch["cond_idxs"] = None
@@ -230,22 +344,15 @@ class XTTSDataset(torch.utils.data.Dataset):
         if torch.any(batch["cond_lens"].isnan()):
             batch["cond_lens"] = None
 
-        max_text_len = batch["text_lengths"].max()
-        max_wav_len = batch["wav_lengths"].max()
-
-        # create padding tensors
-        text_padded = torch.IntTensor(B, max_text_len)
-        wav_padded = torch.FloatTensor(B, 1, max_wav_len)
+        # zero padded in a single allocation and copy
+        batch["padded_text"] = torch.nn.utils.rnn.pad_sequence(batch["text"], batch_first=True).int()
 
-        # initialize tensors for zero padding
-        text_padded = text_padded.zero_()
-        wav_padded = wav_padded.zero_()
-        for i in range(B):
-            text = batch["text"][i]
-            text_padded[i, : batch["text_lengths"][i]] = torch.IntTensor(text)
-            wav = batch["wav"][i]
-            wav_padded[i, :, : batch["wav_lengths"][i]] = torch.FloatTensor(wav)
+        if "audio_codes" in batch:
+            # precomputed codes replace the waves, the GPT pads them with the stop token past the wav lengths
+            batch["audio_codes"] = torch.nn.utils.rnn.pad_sequence(batch["audio_codes"], batch_first=True)
+            del batch["wav"]
+            return batch
 
-        batch["wav"] = wav_padded
-        batch["padded_text"] = text_padded
+        wavs = [wav.reshape(-1) for wav in batch["wav"]]
+        batch["wav"] = torch.nn.utils.rnn.pad_sequence(wavs, batch_first=True).float().unsqueeze(1)
         return batch
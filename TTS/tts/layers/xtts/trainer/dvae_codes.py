@@ -0,0 +1,123 @@
+import json
+import os
+
+import numpy as np
+import torch
+import torchaudio
+from tqdm import tqdm
+
+from TTS.tts.models.xtts import load_audio
+
+
+@torch.no_grad()
+def compute_dvae_codes(dvae, mel_extractor, wav, sample_rate, dvae_sample_rate):
+    """Compute the DVAE codes of `wav` (b, 1, t) sampled at `sample_rate`, the GPT targets.
+
+    `mel_extractor` is the DVAE `TorchMelSpectrogram`, at `dvae_sample_rate`.
+    """
+    if sample_rate != dvae_sample_rate:
+        wav = torchaudio.functional.resample(
+            wav,
+            orig_freq=sample_rate,
+            new_freq=dvae_sample_rate,
+            lowpass_filter_width=64,
+            rolloff=0.9475937167399596,
+            resampling_method="kaiser_window",
+            beta=14.769656459379492,
+        )
+    return dvae.get_codebook_indices(mel_extractor(wav))
+
+
+class DVAECodeStore:
+    """Precomputed DVAE codes of a dataset, keyed by audio path.
+
+    The codes of all the clips are concatenated in a single memory-mapped `codes.bin` file, and `index.json` holds the
+    offset and length of each clip along with the audio settings the codes were computed with. The memory map is opened
+    on first access so the store can be sent to `DataLoader` workers.
+
+    Use `DVAECodeStore.build()` or `precompute_dvae_codes.py` to create a store.
+
+    Args:
+        path (str): Directory of the store.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r", encoding="utf-8") as f:
+            index = json.load(f)
+        self.sample_rate = index["sample_rate"]
+        self.dvae_sample_rate = index["dvae_sample_rate"]
+        self.dtype = np.dtype(index["dtype"])
+        self.items = index["items"]
+        self._codes = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, audio_path):
+        return os.path.abspath(audio_path) in self.items
+
+    def __getitem__(self, audio_path):
+        """Return the codes of `audio_path` as a LongTensor (t,)."""
+        if self._codes is None:
+            self._codes = np.memmap(os.path.join(self.path, "codes.bin"), dtype=self.dtype, mode="r")
+        offset, length = self.items[os.path.abspath(audio_path)]
+        return torch.from_numpy(self._codes[offset : offset + length].astype(np.int64))
+
+    def __getstate__(self):
+        # do not pickle the memory map, each worker opens its own
+        state = self.__dict__.copy()
+        state["_codes"] = None
+        return state
+
+    def check_audio_config(self, sample_rate, dvae_sample_rate):
+        if (self.sample_rate, self.dvae_sample_rate) != (sample_rate, dvae_sample_rate):
+            raise ValueError(
+                f" [!] DVAE codes in {self.path} were computed with sample_rate={self.sample_rate} and "
+                f"dvae_sample_rate={self.dvae_sample_rate}, but the training config uses sample_rate={sample_rate} "
+                f"and dvae_sample_rate={dvae_sample_rate}."
+            )
+
+    @classmethod
+    @torch.no_grad()
+    def build(cls, path, samples, dvae, mel_extractor, sample_rate, dvae_sample_rate, device="cpu"):
+        """Compute the codes of the `load_tts_samples()` `samples` and write them to a new store in `path`.
+
+        Each clip is loaded and encoded on its own, as `XTTSDataset` loads it, so its codes do not depend on the
+        padding of a batch. Clips that fail to load are skipped and reported.
+        """
+        os.makedirs(path, exist_ok=True)
+        dtype = np.int16 if dvae.num_tokens <= np.iinfo(np.int16).max else np.int32
+        dvae = dvae.to(device).eval()
+        items = {}
+        offset = 0
+        failed = []
+        with open(os.path.join(path, "codes.bin"), "wb") as f:
+            for sample in tqdm(samples):
+                audio_path = os.path.abspath(sample["audio_file"])
+                if audio_path in items:
+                    continue
+                try:
+                    wav = load_audio(audio_path, sample_rate)
+                except Exception:  # pylint: disable=broad-except
+                    failed.append(audio_path)
+                    continue
+                codes = compute_dvae_codes(dvae, mel_extractor, wav.unsqueeze(0).to(device), sample_rate, dvae_sample_rate)
+                codes = codes[0].cpu().numpy().astype(dtype)
+                f.write(codes.tobytes())
+                items[audio_path] = [offset, len(codes)]
+                offset += len(codes)
+
+        index = {
+            "sample_rate": sample_rate,
+            "dvae_sample_rate": dvae_sample_rate,
+            "dtype": np.dtype(dtype).name,
+            "items": items,
+        }
+        # written last, a store without index is an interrupted build
+        with open(os.path.join(path, "index.json"), "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        print(f" > DVAE codes of {len(items)} clips ({offset} codes) saved to {path}")
+        if failed:
+            print(f" > {len(failed)} clips could not be loaded, e.g. {failed[0]}")
+        return cls(path)
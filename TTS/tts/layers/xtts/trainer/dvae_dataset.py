@@ -1,5 +1,10 @@
-import torch
+import os
 import random
+
+import torch
+
+from TTS.tts.layers.xtts.trainer.audio_shards import AudioShardStore
+from TTS.tts.layers.xtts.trainer.sample_manifest import SampleManifest
 from TTS.tts.models.xtts import load_audio
 
 torch.set_num_threads(1)
@@ -16,13 +21,23 @@ def key_samples_by_col(samples, col):
     return samples_by_col
 
 class DVAEDataset(torch.utils.data.Dataset):
-    def __init__(self, samples, sample_rate, is_eval, max_wav_len=255995):
+    def __init__(self, samples, sample_rate, is_eval, max_wav_len=255995, audio_shards_path=None, manifest_path=None, crop_len=None):
         self.sample_rate = sample_rate
+        # clips longer than `crop_len` samples are cropped to it, at random in training and from the start in eval
+        self.crop_len = crop_len
+        # packed audio shards, read instead of the audio files
+        self.audio_shards = None
+        if audio_shards_path:
+            self.audio_shards = AudioShardStore(audio_shards_path)
+            self.audio_shards.check_sample_rate(sample_rate)
         self.is_eval = is_eval
         self.max_wav_len = max_wav_len
         self.samples = samples
         self.training_seed = 1
         self.failed_samples = set()
+        # drop the samples out of the length limits before training instead of when they are drawn
+        self.manifest = SampleManifest(manifest_path)
+        self.filter_samples()
         if not is_eval:
             random.seed(self.training_seed)
             # random.shuffle(self.samples)
@@ -30,31 +45,65 @@ class DVAEDataset(torch.utils.data.Dataset):
             # order by language
             self.samples = key_samples_by_col(self.samples, "language")
             print(" > Sampling by language:", self.samples.keys())
-        else:
-            # for evaluation load and check samples that are corrupted to ensures the reproducibility
-            self.check_eval_samples()
-
-    def check_eval_samples(self):
-        print(" > Filtering invalid eval samples!!")
+            # (language, index) of the sample of each dataset index, used when a batch sampler picks the samples
+            self.sample_index = [
+                (lang, idx) for lang, lang_samples in self.samples.items() for idx in range(len(lang_samples))
+            ]
+        # if False, `__getitem__` ignores the index of training samples and draws a random language and sample
+        self.use_sampler_index = False
+
+    def get_audio_length(self, audiopath):
+        """Number of samples of `audiopath` at the dataset sample rate, read from the file header."""
+        if self.audio_shards is not None and audiopath in self.audio_shards:
+            return self.audio_shards.items[os.path.abspath(audiopath)][2]
+        return self.manifest.num_samples(audiopath, self.sample_rate)
+
+    def filter_samples(self):
+        """Drop the samples that cannot be read or are out of the length limits, reading only the audio headers."""
+        print(f" > Filtering invalid {'eval' if self.is_eval else 'train'} samples!!")
+        audio_paths = [
+            sample["audio_file"]
+            for sample in self.samples
+            if self.audio_shards is None or sample["audio_file"] not in self.audio_shards
+        ]
+        failed = self.manifest.update(audio_paths)
         new_samples = []
         for sample in self.samples:
-            try:
-                _, wav = self.load_item(sample)
-            except:
+            if os.path.abspath(sample["audio_file"]) in failed:
                 continue
-            # Basically, this audio file is nonexistent or too long to be supported by the dataset.
-            if (
-                wav is None
-                or (self.max_wav_len is not None and wav.shape[-1] > self.max_wav_len)
-            ):
+            wav_length = self.get_audio_length(sample["audio_file"])
+            # Ultra short clips are also useless (and can cause problems within some models).
+            if wav_length < 0.5 * self.sample_rate or (self.max_wav_len is not None and wav_length > self.max_wav_len):
                 continue
             new_samples.append(sample)
+        self.manifest.save()
+        print(f" > Total samples after filtering: {len(new_samples)} of {len(self.samples)}")
         self.samples = new_samples
-        print(" > Total eval samples after filtering:", len(self.samples))
+
+    def get_lengths(self):
+        """Audio length after cropping and language of each dataset index, for the length-bucketed batch sampler."""
+        wav_lengths, languages = [], []
+        for lang, idx in self.sample_index:
+            wav_length = self.get_audio_length(self.samples[lang][idx]["audio_file"])
+            wav_lengths.append(wav_length if self.crop_len is None else min(wav_length, self.crop_len))
+            languages.append(lang)
+        return wav_lengths, languages
+
+    def get_retry_index(self, index):
+        """Index of the sample loaded instead of the invalid sample `index`.
+
+        Eval takes the next sample so the eval loss is reproducible, training a random one.
+        """
+        if self.is_eval:
+            return (index + 1) % len(self)
+        return random.randrange(len(self))
 
     def load_item(self, sample):
         audiopath = sample["audio_file"]
-        wav = load_audio(audiopath, self.sample_rate)
+        if self.audio_shards is not None and audiopath in self.audio_shards:
+            wav = self.audio_shards.load(audiopath)
+        else:
+            wav = load_audio(audiopath, self.sample_rate)
         if wav is None or wav.shape[-1] < (0.5 * self.sample_rate):
             # Ultra short clips are also useless (and can cause problems within some models).
             raise ValueError
@@ -65,6 +114,10 @@ class DVAEDataset(torch.utils.data.Dataset):
         if self.is_eval:
             sample = self.samples[index]
             sample_id = str(index)
+        elif self.use_sampler_index:
+            lang, index = self.sample_index[index]
+            sample = self.samples[lang][index]
+            sample_id = lang + "_" + str(index)
         else:
             # select a random language
             lang = random.choice(list(self.samples.keys()))
@@ -77,14 +130,14 @@ class DVAEDataset(torch.utils.data.Dataset):
         # ignore samples that we already know that is not valid ones
         if sample_id in self.failed_samples:
             # call get item again to get other sample
-            return self[1]
+            return self[self.get_retry_index(index)]
 
         # try to load the sample, if fails added it to the failed samples list
         try:
             audiopath, wav = self.load_item(sample)
         except:
             self.failed_samples.add(sample_id)
-            return self[1]
+            return self[self.get_retry_index(index)]
 
         # check if the audio and text size limits and if it out of the limits, added it failed_samples
         if (
@@ -94,7 +147,11 @@ class DVAEDataset(torch.utils.data.Dataset):
             # Basically, this audio file is nonexistent or too long to be supported by the dataset.
             # It's hard to handle this situation properly. Best bet is to return the a random valid token and skew the dataset somewhat as a result.
             self.failed_samples.add(sample_id)
-            return self[1]
+            return self[self.get_retry_index(index)]
+
+        if self.crop_len is not None and wav.shape[-1] > self.crop_len:
+            start = 0 if self.is_eval else random.randint(0, wav.shape[-1] - self.crop_len)
+            wav = wav[:, start : start + self.crop_len]
 
         res = {
             "wav": wav,
@@ -110,23 +167,12 @@ class DVAEDataset(torch.utils.data.Dataset):
 
     def collate_fn(self, batch):
         # convert list of dicts to dict of lists
-        B = len(batch)
-
         batch = {k: [dic[k] for dic in batch] for k in batch[0]}
 
         # stack for features that already have the same shape
         batch["wav_lengths"] = torch.stack(batch["wav_lengths"])
 
-        max_wav_len = batch["wav_lengths"].max()
-
-        # create padding tensors
-        wav_padded = torch.FloatTensor(B, 1, max_wav_len)
-
-        # initialize tensors for zero padding
-        wav_padded = wav_padded.zero_()
-        for i in range(B):
-            wav = batch["wav"][i]
-            wav_padded[i, :, : batch["wav_lengths"][i]] = torch.FloatTensor(wav)
-
-        batch["wav"] = wav_padded
-        return batch
\ No newline at end of file
+        # zero padded in a single allocation and copy
+        wavs = [wav.reshape(-1) for wav in batch["wav"]]
+        batch["wav"] = torch.nn.utils.rnn.pad_sequence(wavs, batch_first=True).float().unsqueeze(1)
+        return batch
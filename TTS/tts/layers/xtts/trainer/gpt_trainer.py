@@ -1,24 +1,26 @@
+import time
 from dataclasses import dataclass, field
 from typing import Dict, List, Tuple, Union
 
 import torch
 import torch.nn as nn
-import torchaudio
 from coqpit import Coqpit
 from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
-from trainer.torch import DistributedSampler
 from trainer.trainer_utils import get_optimizer, get_scheduler
 
 from TTS.tts.configs.xtts_config import XttsConfig
-from TTS.tts.datasets.dataset import TTSDataset
 from TTS.tts.layers.tortoise.arch_utils import TorchMelSpectrogram
 from TTS.tts.layers.xtts.dvae import DiscreteVAE
 from TTS.tts.layers.xtts.tokenizer import VoiceBpeTokenizer
 from TTS.tts.layers.xtts.trainer.dataset import XTTSDataset
+from TTS.tts.layers.xtts.trainer.dvae_codes import compute_dvae_codes
+from TTS.tts.layers.xtts.trainer.prefetcher import DevicePrefetcher
 from TTS.tts.models.base_tts import BaseTTS
 from TTS.tts.models.xtts import Xtts, XttsArgs, XttsAudioConfig
 from TTS.utils.io import load_fsspec
+from TTS.utils.samplers import LanguageBucketBatchSampler
 
 
 @dataclass
@@ -29,6 +31,20 @@ class GPTTrainerConfig(XttsConfig):
     weighted_loss_attrs: dict = field(default_factory=lambda: {})
     weighted_loss_multipliers: dict = field(default_factory=lambda: {})
     test_sentences: List[dict] = field(default_factory=lambda: [])
+    # length-bucketed batches of a single language, see `LanguageBucketBatchSampler`
+    use_length_bucketing: bool = False
+    bucket_size: int = 2000
+    # batch budgets, if any is defined the batch size varies to fit them instead of being batch_size (implies bucketing)
+    max_tokens_per_batch: int = None  # padded GPT tokens (text tokens + audio codes)
+    max_audio_seconds_per_batch: float = None  # padded audio seconds
+    max_text_tokens_per_batch: int = None  # padded text tokens
+    # memory savings: recompute the activations of one GPT block out of N in the backward pass (0 disables), freeze the
+    # N lowest GPT blocks and keep the optimizer state in 8 bits (needs bitsandbytes)
+    gpt_checkpoint_every_n_layers: int = 0
+    gpt_freeze_layers: int = 0
+    optimizer_8bit: bool = False
+    # pin the batches and copy them to the GPU on a side stream while the previous step runs (CUDA only)
+    prefetch_to_device: bool = True
 
 
 @dataclass
@@ -49,6 +65,10 @@ class GPTArgs(XttsArgs):
     tokenizer_file: str = ""
     mel_norm_file: str = "https://coqui.gateway.scarf.sh/v0.14.0_models/mel_norms.pth"
     dvae_checkpoint: str = ""
+    dvae_codes_path: str = ""  # precomputed DVAE codes (see precompute_dvae_codes.py), skips the DVAE during training
+    audio_shards_path: str = ""  # audio packed with pack_audio_shards.py, read instead of the audio files
+    sample_manifest_path: str = ""  # if defined the sample lengths used to filter and bucket samples are cached there
+    audio_cache_dir: str = ""  # if defined the decoded training audio is cached there as float16 and reused across epochs
     xtts_checkpoint: str = ""
     gpt_checkpoint: str = ""  # if defined it will replace the gpt weights on xtts model
     vocoder: str = ""  # overide vocoder key on the config to avoid json write issues
@@ -73,6 +93,12 @@ class GPTTrainer(BaseTTS):
         """
         super().__init__(config, ap=None, tokenizer=None)
         self.config = config
+        self.check_precision(config)
+        self.last_step_time = None
+        # samples, tokens and seconds of the current training epoch
+        self.epoch_throughput = [0, 0, 0.0]
+        # DDP wrapper of the model, see `on_init_end()`
+        self.ddp_model = None
         # init XTTS model
         self.xtts = Xtts(self.config)
         # create the tokenizer with the target vocabulary
@@ -141,6 +167,15 @@ class GPTTrainer(BaseTTS):
             self.xtts.gpt.load_state_dict(gpt_checkpoint, strict=True)
             print(">> GPT weights restored from:", self.args.gpt_checkpoint)
 
+        if config.gpt_checkpoint_every_n_layers > 0:
+            self.xtts.gpt.set_gradient_checkpointing(config.gpt_checkpoint_every_n_layers)
+        if config.gpt_freeze_layers > 0:
+            self.xtts.gpt.freeze_layers(config.gpt_freeze_layers)
+        if config.gpt_checkpoint_every_n_layers > 0 or config.gpt_freeze_layers > 0:
+            num_params = sum(p.numel() for p in self.xtts.gpt.parameters())
+            num_trainable = sum(p.numel() for p in self.xtts.gpt.parameters() if p.requires_grad)
+            print(f" > GPT trainable parameters: {num_trainable} / {num_params}")
+
         # Mel spectrogram extractor for conditioning
         if self.args.gpt_use_perceiver_resampler:
             self.torch_mel_spectrogram_style_encoder = TorchMelSpectrogram(
@@ -196,10 +231,32 @@ class GPTTrainer(BaseTTS):
             mel_norm_file=self.args.mel_norm_file, sampling_rate=config.audio.dvae_sample_rate
         )
 
+        # only the GPT is trained, the DVAE, mel extractors and decoder are used as is (and replicated as is by DDP)
+        for name, param in self.named_parameters():
+            if not name.startswith("xtts.gpt."):
+                param.requires_grad_(False)
+
     @property
     def device(self):
         return next(self.parameters()).device
 
+    @staticmethod
+    def check_precision(config: Coqpit):
+        """Fall back to a mixed precision mode the device supports.
+
+        The trainer runs `train_step` under `torch.autocast` when `config.mixed_precision` is set, with fp32 master
+        weights and, for fp16, a `GradScaler`. On CPU it would autocast to bf16, which is slower than fp32 for most
+        CPU ops, so mixed precision is turned off. GPUs without bf16 support train in fp16 with loss scaling instead.
+        """
+        if not config.mixed_precision:
+            return
+        if not torch.cuda.is_available():
+            print(" > Mixed precision needs a CUDA device, training in fp32.")
+            config.mixed_precision = False
+        elif config.precision == "bf16" and not torch.cuda.is_bf16_supported():
+            print(" > bf16 is not supported by the GPU, training in fp16 with loss scaling.")
+            config.precision = "fp16"
+
     def forward(self, text_inputs, text_lengths, audio_codes, wav_lengths, cond_mels, cond_idxs, cond_lens):
         """
         Forward pass that uses both text and voice in either text conditioning mode or voice conditioning mode
@@ -273,26 +330,18 @@ class GPTTrainer(BaseTTS):
         paired_conditioning_mel = paired_conditioning_mel.view(B, num_cond_samples, n_mel, T_mel)
         # get the conditioning embeddings
         batch["cond_mels"] = paired_conditioning_mel
-        # compute codes using DVAE
-        if self.config.audio.sample_rate != self.config.audio.dvae_sample_rate:
-            dvae_wav = torchaudio.functional.resample(
+        # compute codes using DVAE, unless the dataset serves precomputed codes
+        if "audio_codes" not in batch:
+            batch["audio_codes"] = compute_dvae_codes(
+                self.dvae,
+                self.torch_mel_spectrogram_dvae,
                 batch["wav"],
-                orig_freq=self.config.audio.sample_rate,
-                new_freq=self.config.audio.dvae_sample_rate,
-                lowpass_filter_width=64,
-                rolloff=0.9475937167399596,
-                resampling_method="kaiser_window",
-                beta=14.769656459379492,
+                self.config.audio.sample_rate,
+                self.config.audio.dvae_sample_rate,
             )
-        else:
-            dvae_wav = batch["wav"]
-        dvae_mel_spec = self.torch_mel_spectrogram_dvae(dvae_wav)
-        codes = self.dvae.get_codebook_indices(dvae_mel_spec)
-
-        batch["audio_codes"] = codes
+            del batch["wav"]
         # delete useless batch tensors
         del batch["padded_text"]
-        del batch["wav"]
         del batch["conditioning"]
         return batch
 
@@ -306,20 +355,47 @@ class GPTTrainer(BaseTTS):
         cond_idxs = batch["cond_idxs"]
         cond_lens = batch["cond_lens"]
 
-        loss_text, loss_mel, _ = self.forward(
+        # the trainer calls `train_step` of the module wrapped by DDP, go through the wrapper to sync the gradients
+        model = self.ddp_model if self.ddp_model is not None and self.xtts.gpt.training else self
+        loss_text, loss_mel, _ = model(
             text_inputs, text_lengths, audio_codes, wav_lengths, cond_mels, cond_idxs, cond_lens
         )
         loss_dict["loss_text_ce"] = loss_text * self.args.gpt_loss_text_ce_weight
         loss_dict["loss_mel_ce"] = loss_mel * self.args.gpt_loss_mel_ce_weight
         loss_dict["loss"] = loss_dict["loss_text_ce"] + loss_dict["loss_mel_ce"]
+        if self.xtts.gpt.training:
+            loss_dict.update(self.get_throughput_stats(len(text_lengths), batch["num_tokens"]))
         return {"model_outputs": None}, loss_dict
 
+    def get_throughput_stats(self, num_samples, num_tokens):
+        """Training throughput since the previous step and peak GPU memory, logged with the losses.
+
+        Throughput counts the samples and the unpadded text and audio tokens of the batch over the wall time between
+        two steps, data loading included. The counts come from the data loader, so no device sync is needed.
+        """
+        stats = {}
+        now = time.perf_counter()
+        if self.last_step_time is not None:
+            elapsed = now - self.last_step_time
+            stats["samples_per_sec"] = num_samples / elapsed
+            stats["tokens_per_sec"] = num_tokens / elapsed
+            self.epoch_throughput[0] += num_samples
+            self.epoch_throughput[1] += num_tokens
+            self.epoch_throughput[2] += elapsed
+        self.last_step_time = now
+        if torch.cuda.is_available() and self.device.type == "cuda":
+            stats["max_memory_allocated_gb"] = torch.cuda.max_memory_allocated(self.device) / 2**30
+        return stats
+
     def eval_step(self, batch, criterion):
         # ignore masking for more consistent evaluation
         batch["cond_idxs"] = None
         return self.train_step(batch, criterion)
 
     def on_train_epoch_start(self, trainer):
+        # do not count the evaluation and the epoch boundary in the throughput
+        self.last_step_time = None
+        self.epoch_throughput = [0, 0, 0.0]
         trainer.model.eval()  # the whole model to eval
         # put gpt model in training mode
         if hasattr(trainer.model, "module") and hasattr(trainer.model.module, "xtts"):
@@ -327,7 +403,36 @@ class GPTTrainer(BaseTTS):
         else:
             trainer.model.xtts.gpt.train()
 
+    def on_train_epoch_end(self, trainer):  # pylint: disable=W0613
+        """Print the throughput and peak GPU memory of each DDP process over the epoch."""
+        peak_memory = 0.0
+        if torch.cuda.is_available() and self.device.type == "cuda":
+            peak_memory = torch.cuda.max_memory_allocated(self.device) / 2**30
+        stats = torch.tensor(self.epoch_throughput + [peak_memory], dtype=torch.float64, device=self.device)
+        all_stats = [stats]
+        if self.ddp_model is not None:
+            all_stats = [torch.zeros_like(stats) for _ in range(torch.distributed.get_world_size())]
+            torch.distributed.all_gather(all_stats, stats)
+            if torch.distributed.get_rank() > 0:
+                return
+        for rank, (num_samples, num_tokens, elapsed, peak_memory) in enumerate(s.tolist() for s in all_stats):
+            if elapsed > 0:
+                print(
+                    f" > Rank {rank}: {num_samples / elapsed:.2f} samples/s, {num_tokens / elapsed:.1f} tokens/s, "
+                    f"peak GPU memory: {peak_memory:.2f} GB"
+                )
+        print(
+            f" > batch_size: {self.config.batch_size}, "
+            f"checkpoint every {self.config.gpt_checkpoint_every_n_layers} layers, "
+            f"{self.config.gpt_freeze_layers} frozen layers, "
+            f"8-bit optimizer: {self.config.optimizer_8bit}, "
+            f"mixed precision: {self.config.precision if self.config.mixed_precision else False}"
+        )
+
     def on_init_end(self, trainer):  # pylint: disable=W0613
+        if isinstance(trainer.model, DistributedDataParallel):
+            # not registered as a submodule, it would add a copy of the weights to the state dict
+            object.__setattr__(self, "ddp_model", trainer.model)
         # ignore similarities.pth on clearml save/upload
         if self.config.dashboard_logger.lower() == "clearml":
             from clearml.binding.frameworks import WeightsFileHandler
@@ -346,9 +451,40 @@ class GPTTrainer(BaseTTS):
     def get_criterion():
         return None
 
-    def get_sampler(self, dataset: TTSDataset, num_gpus=1):
-        # sampler for DDP
-        batch_sampler = DistributedSampler(dataset) if num_gpus > 1 else None
+    @staticmethod
+    def use_batch_budget(config: Coqpit):
+        return any(
+            (config.max_tokens_per_batch, config.max_audio_seconds_per_batch, config.max_text_tokens_per_batch)
+        )
+
+    def get_batch_sampler(self, config: Coqpit, dataset: XTTSDataset, num_gpus=1, rank=0):
+        """Length-bucketed, language-balanced batch sampler of the training set, sharded across the `num_gpus` DDP
+        processes.
+
+        Without bucketing or batch budgets (multi-GPU only) the buckets are a single batch, so the batches are random
+        samples of a language as without a sampler.
+        """
+        print(" > Computing the sample lengths for the batch sampler.")
+        bucketing = config.use_length_bucketing or self.use_batch_budget(config)
+        wav_lengths, text_lengths, languages = dataset.get_lengths()
+        max_wav_length = None
+        if config.max_audio_seconds_per_batch:
+            max_wav_length = int(config.max_audio_seconds_per_batch * config.audio.sample_rate)
+        batch_sampler = LanguageBucketBatchSampler(
+            wav_lengths,
+            text_lengths,
+            languages,
+            batch_size=None if self.use_batch_budget(config) else config.batch_size,
+            max_tokens=config.max_tokens_per_batch,
+            max_wav_length=max_wav_length,
+            max_text_tokens=config.max_text_tokens_per_batch,
+            code_stride_len=self.args.gpt_code_stride_len,
+            bucket_size=config.bucket_size if bucketing else config.batch_size,
+            seed=config.training_seed,
+            num_replicas=num_gpus,
+            rank=rank or 0,
+        )
+        dataset.use_sampler_index = True
         return batch_sampler
 
     def get_data_loader(
@@ -374,29 +510,30 @@ class GPTTrainer(BaseTTS):
             # sort input sequences from short to long
             # dataset.preprocess_samples()
 
-            # get samplers
-            sampler = self.get_sampler(dataset, num_gpus)
+            prefetch = config.prefetch_to_device and torch.cuda.is_available()
 
             # ignore sampler when is eval because if we changed the sampler parameter we will not be able to compare previous runs
-            if sampler is None or is_eval:
+            # in DDP the batch sampler also splits the training set across the processes
+            if (config.use_length_bucketing or self.use_batch_budget(config) or num_gpus > 1) and not is_eval:
                 loader = DataLoader(
                     dataset,
-                    batch_size=config.eval_batch_size if is_eval else config.batch_size,
-                    shuffle=False,
-                    drop_last=False,
+                    batch_sampler=self.get_batch_sampler(config, dataset, num_gpus, rank),
                     collate_fn=dataset.collate_fn,
-                    num_workers=config.num_eval_loader_workers if is_eval else config.num_loader_workers,
-                    pin_memory=False,
+                    num_workers=config.num_loader_workers,
+                    pin_memory=prefetch,
                 )
             else:
                 loader = DataLoader(
                     dataset,
-                    sampler=sampler,
-                    batch_size = config.eval_batch_size if is_eval else config.batch_size,
+                    batch_size=config.eval_batch_size if is_eval else config.batch_size,
+                    shuffle=False,
+                    drop_last=False,
                     collate_fn=dataset.collate_fn,
                     num_workers=config.num_eval_loader_workers if is_eval else config.num_loader_workers,
-                    pin_memory=False,
+                    pin_memory=prefetch,
                 )
+            if prefetch:
+                loader = DevicePrefetcher(loader)
         return loader
 
     def get_optimizer(self) -> List:
@@ -425,6 +562,8 @@ class GPTTrainer(BaseTTS):
             param_map = {}
             for mn, m in net.named_modules():
                 for k, v in m.named_parameters():
+                    if not v.requires_grad:
+                        continue
                     v.is_bias = k.endswith(".bias")
                     v.is_weight = k.endswith(".weight")
                     v.is_norm = isinstance(m, norm_modules)
@@ -446,22 +585,25 @@ class GPTTrainer(BaseTTS):
                 {"params": params_notweights, "weight_decay": 0},
             ]
             # torch.optim.AdamW
-            opt = get_optimizer(
-                self.config.optimizer,
-                self.config.optimizer_params,
-                self.config.lr,
-                parameters=groups,
-            )
+            opt = self.build_optimizer(groups)
             opt._group_names = [params_names_weights, params_names_notweights]
             return opt
 
-        return get_optimizer(
-            self.config.optimizer,
-            self.config.optimizer_params,
-            self.config.lr,
-            # optimize only for the GPT model
-            parameters=self.xtts.gpt.parameters(),
-        )
+        # optimize only for the GPT model
+        return self.build_optimizer([p for p in self.xtts.gpt.parameters() if p.requires_grad])
+
+    def build_optimizer(self, parameters):
+        """Create `config.optimizer` for `parameters`, from bitsandbytes if `config.optimizer_8bit` is set."""
+        if not self.config.optimizer_8bit:
+            return get_optimizer(self.config.optimizer, self.config.optimizer_params, self.config.lr, parameters=parameters)
+        try:
+            import bitsandbytes as bnb
+        except ImportError as e:
+            raise ImportError(" [!] `optimizer_8bit` needs bitsandbytes: `pip install bitsandbytes`.") from e
+        optimizer = getattr(bnb.optim, f"{self.config.optimizer}8bit", None)
+        if optimizer is None:
+            raise ValueError(f" [!] bitsandbytes has no 8-bit version of the {self.config.optimizer} optimizer.")
+        return optimizer(parameters, lr=self.config.lr, **self.config.optimizer_params)
 
     def get_scheduler(self, optimizer) -> List:
         """Set the scheduler for the optimizer.
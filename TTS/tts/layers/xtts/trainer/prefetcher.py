@@ -0,0 +1,51 @@
+import torch
+
+
+class DevicePrefetcher:
+    """Iterate over a `DataLoader` with batches already copied to the GPU.
+
+    The host-to-device copy of the next batch is issued on a side CUDA stream as soon as the current batch is handed
+    out, so it overlaps the training step instead of stalling it. The `DataLoader` should pin its batches
+    (`pin_memory=True`) for the copies to be asynchronous. The pinned host buffers come from the PyTorch caching host
+    allocator, so they are reused across batches once their copy is done.
+
+    Args:
+        loader (DataLoader): loader of dict batches.
+        device (torch.device, optional): target device. Defaults to the current CUDA device.
+    """
+
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        self.device = torch.device("cuda", torch.cuda.current_device()) if device is None else device
+        self.stream = torch.cuda.Stream(self.device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        """Issue the copies of the tensors of `batch` on the side stream. Returns the batch and its copy event."""
+        with torch.cuda.stream(self.stream):
+            batch = {k: v.to(self.device, non_blocking=True) if torch.is_tensor(v) else v for k, v in batch.items()}
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        return batch, event
+
+    def wait(self, batch, event):
+        """Make the current stream wait for the copy of `batch` and hand its tensors over to the current stream."""
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(event)
+        for v in batch.values():
+            if torch.is_tensor(v):
+                # the memory was allocated on the side stream, do not reuse it before the current stream is done
+                v.record_stream(stream)
+        return batch
+
+    def __iter__(self):
+        pending = None
+        for batch in self.loader:
+            batch = self.to_device(batch)
+            if pending is not None:
+                yield self.wait(*pending)
+            pending = batch
+        if pending is not None:
+            yield self.wait(*pending)
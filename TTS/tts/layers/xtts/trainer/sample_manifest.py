@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torchaudio
+
+
+class SampleManifest:
+    """Cache of the lengths of the training samples: audio frames and sample rate, and number of text tokens.
+
+    Audio entries are read from the file headers only, keyed on the absolute path and checked against the size and
+    modification time of the file, so an edited file is read again. Text entries are keyed on the language and text and
+    only kept for the tokenizer they were computed with. If `path` is given, the manifest is loaded from and saved to
+    that JSON file so the lengths are computed once across runs.
+
+    Args:
+        path (str, optional): JSON file of the manifest. If None, the manifest is kept in memory.
+        tokenizer_id (str, optional): fingerprint of the tokenizer, see `SampleManifest.tokenizer_id()`.
+    """
+
+    def __init__(self, path=None, tokenizer_id=None):
+        self.path = path
+        self.tokenizer_id = tokenizer_id
+        self.items = {}
+        self.text_lengths = {}
+        self._dirty = False
+        if path is not None and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            self.items = manifest["items"]
+            if manifest.get("tokenizer") == tokenizer_id:
+                self.text_lengths = manifest.get("text_lengths", {})
+
+    @staticmethod
+    def tokenizer_id(tokenizer):
+        """Fingerprint of a `VoiceBpeTokenizer`."""
+        return hashlib.sha256(tokenizer.tokenizer.to_str().encode()).hexdigest()
+
+    def _read_header(self, audio_path):
+        stat = os.stat(audio_path)
+        entry = self.items.get(audio_path)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            info = torchaudio.info(audio_path)
+            entry = [stat.st_size, stat.st_mtime_ns, info.num_frames, info.sample_rate]
+        return entry
+
+    def update(self, audio_paths, num_workers=16):
+        """Read the headers of the `audio_paths` missing from the manifest or changed, with `num_workers` threads.
+
+        Returns:
+            set: the absolute paths that could not be read.
+        """
+        audio_paths = list(dict.fromkeys(os.path.abspath(audio_path) for audio_path in audio_paths))
+
+        def _read(audio_path):
+            try:
+                return self._read_header(audio_path)
+            except Exception:  # pylint: disable=broad-except
+                return None
+
+        failed = set()
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for audio_path, entry in zip(audio_paths, executor.map(_read, audio_paths)):
+                if entry is None:
+                    failed.add(audio_path)
+                elif self.items.get(audio_path) != entry:
+                    self.items[audio_path] = entry
+                    self._dirty = True
+        return failed
+
+    def get(self, audio_path):
+        """Return `(num_frames, sample_rate)` of `audio_path`, read if missing. `update()` refreshes stale entries."""
+        audio_path = os.path.abspath(audio_path)
+        if audio_path not in self.items:
+            self.items[audio_path] = self._read_header(audio_path)
+            self._dirty = True
+        entry = self.items[audio_path]
+        return entry[2], entry[3]
+
+    def num_samples(self, audio_path, sample_rate):
+        """Number of samples of `audio_path` once resampled to `sample_rate`."""
+        num_frames, file_sample_rate = self.get(audio_path)
+        return int(num_frames * sample_rate / file_sample_rate)
+
+    def text_length(self, text, language, tokenize):
+        """Number of tokens of `text` in `language`, `tokenize(text, language)` is called on a miss.
+
+        Returns None if `tokenize` raises, e.g. for texts with unknown tokens.
+        """
+        key = f"{language}:{text}"
+        if key not in self.text_lengths:
+            try:
+                self.text_lengths[key] = len(tokenize(text, language))
+            except Exception:  # pylint: disable=broad-except
+                self.text_lengths[key] = None
+            self._dirty = True
+        return self.text_lengths[key]
+
+    def save(self):
+        """Write the manifest to `path` if entries were added since it was loaded."""
+        if self.path is None or not self._dirty:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"items": self.items, "tokenizer": self.tokenizer_id, "text_lengths": self.text_lengths}, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
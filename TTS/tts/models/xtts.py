@@ -1,4 +1,10 @@
+import hashlib
+import math
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
 import librosa
@@ -9,7 +15,9 @@ from coqpit import Coqpit
 
 from TTS.tts.layers.xtts.gpt import GPT
 from TTS.tts.layers.xtts.hifigan_decoder import HifiDecoder
+from TTS.tts.layers.xtts.speaker_cache import SpeakerLatentCache
 from TTS.tts.layers.xtts.stream_generator import init_stream_support
+from TTS.tts.layers.xtts.streaming import StreamingPolicy, StreamingVocoder
 from TTS.tts.layers.xtts.tokenizer import VoiceBpeTokenizer, split_sentence
 from TTS.tts.layers.xtts.xtts_manager import SpeakerManager, LanguageManager
 from TTS.tts.models.base_tts import BaseTTS
@@ -32,6 +40,7 @@ def wav_to_mel_cloning(
     f_min=0,
     f_max=8000,
     n_mels=80,
+    mel_stft=None,
 ):
     """
     Convert waveform to mel-spectrogram with hard-coded parameters for cloning.
@@ -41,22 +50,25 @@ def wav_to_mel_cloning(
         mel_norms_file (str): Path to mel-spectrogram normalization file.
         mel_norms (torch.Tensor): Mel-spectrogram normalization tensor.
         device (torch.device): Device to use for computation.
+        mel_stft (torchaudio.transforms.MelSpectrogram, optional): Prebuilt transform on `device`. If given, the
+            transform parameters are ignored.
 
     Returns:
         torch.Tensor: Mel-spectrogram tensor.
     """
-    mel_stft = torchaudio.transforms.MelSpectrogram(
-        n_fft=n_fft,
-        hop_length=hop_length,
-        win_length=win_length,
-        power=power,
-        normalized=normalized,
-        sample_rate=sample_rate,
-        f_min=f_min,
-        f_max=f_max,
-        n_mels=n_mels,
-        norm="slaney",
-    ).to(device)
+    if mel_stft is None:
+        mel_stft = torchaudio.transforms.MelSpectrogram(
+            n_fft=n_fft,
+            hop_length=hop_length,
+            win_length=win_length,
+            power=power,
+            normalized=normalized,
+            sample_rate=sample_rate,
+            f_min=f_min,
+            f_max=f_max,
+            n_mels=n_mels,
+            norm="slaney",
+        ).to(device)
     wav = wav.to(device)
     mel = mel_stft(wav)
     mel = torch.log(torch.clamp(mel, min=1e-5))
@@ -129,6 +141,8 @@ class XttsArgs(Coqpit):
         gpt_batch_size (int): The size of the auto-regressive batch.
         enable_redaction (bool, optional): Whether to enable redaction. Defaults to True.
         kv_cache (bool, optional): Whether to use the kv_cache. Defaults to True.
+        static_kv_cache (bool, optional): Whether to preallocate the kv_cache for the maximum sequence length and
+            write it in place, giving shape-stable decoding steps. Requires `kv_cache`. Defaults to False.
         gpt_checkpoint (str, optional): The checkpoint for the autoregressive model. Defaults to None.
         clvp_checkpoint (str, optional): The checkpoint for the ConditionalLatentVariablePerseq model. Defaults to None.
         decoder_checkpoint (str, optional): The checkpoint for the DiffTTS model. Defaults to None.
@@ -148,11 +162,13 @@ class XttsArgs(Coqpit):
         gpt_code_stride_len (int, optional): The hop_size of dvae and consequently of the gpt output. Defaults to 1024.
         gpt_use_masking_gt_prompt_approach (bool, optional):  If True, it will use ground truth as prompt and it will mask the loss to avoid repetition. Defaults to True.
         gpt_use_perceiver_resampler (bool, optional):  If True, it will use perceiver resampler from flamingo paper - https://arxiv.org/abs/2204.14198. Defaults to False.
+        gpt_attn_implementation (str, optional): Attention kernel of the GPT blocks, "eager", "sdpa" or "flash_attention_2". Defaults to None, the transformers default.
     """
 
     gpt_batch_size: int = 1
     enable_redaction: bool = False
     kv_cache: bool = True
+    static_kv_cache: bool = False
     gpt_checkpoint: str = None
     clvp_checkpoint: str = None
     decoder_checkpoint: str = None
@@ -175,6 +191,7 @@ class XttsArgs(Coqpit):
     gpt_code_stride_len: int = 1024
     gpt_use_masking_gt_prompt_approach: bool = True
     gpt_use_perceiver_resampler: bool = False
+    gpt_attn_implementation: str = None
 
     # HifiGAN Decoder params
     input_sample_rate: int = 22050
@@ -215,6 +232,13 @@ class Xtts(BaseTTS):
         self.init_models()
         self.register_buffer("mel_stats", torch.ones(80))
 
+        self.speaker_cache = None
+        self._conditioning_fingerprint = None
+        # mel transforms of `get_gpt_cond_latents()`, keyed on their parameters and device
+        self._mel_transforms = {}
+        if config.speaker_cache_size > 0:
+            self.enable_speaker_cache(config.speaker_cache_size, config.speaker_cache_dir)
+
     def init_models(self):
         """Initialize the models. We do it here since we need to load the tokenizer first."""
         if self.tokenizer.tokenizer is not None:
@@ -238,6 +262,7 @@ class Xtts(BaseTTS):
                 stop_audio_token=self.args.gpt_stop_audio_token,
                 use_perceiver_resampler=self.args.gpt_use_perceiver_resampler,
                 code_stride_len=self.args.gpt_code_stride_len,
+                attn_implementation=self.args.gpt_attn_implementation,
             )
 
         self.hifigan_decoder = HifiDecoder(
@@ -254,10 +279,53 @@ class Xtts(BaseTTS):
     def device(self):
         return next(self.parameters()).device
 
+    def enable_speaker_cache(self, max_items=128, cache_dir=None):
+        """Cache the outputs of `get_conditioning_latents()` keyed on the content of the reference audio files.
+
+        Args:
+            max_items (int): Number of voices kept in memory. Defaults to 128.
+            cache_dir (str, optional): Directory where the latents are also saved to survive restarts. Defaults to None.
+        """
+        self.speaker_cache = SpeakerLatentCache(max_items=max_items, cache_dir=cache_dir)
+
+    def conditioning_fingerprint(self):
+        """Hash of the weights the conditioning latents depend on, part of the speaker cache keys."""
+        if self._conditioning_fingerprint is None:
+            hash_func = hashlib.sha256()
+            modules = [self.gpt.conditioning_encoder, self.hifigan_decoder.speaker_encoder]
+            if self.args.gpt_use_perceiver_resampler:
+                modules.append(self.gpt.conditioning_perceiver)
+            tensors = [self.mel_stats] + [t for module in modules for t in module.state_dict().values()]
+            for t in tensors:
+                hash_func.update(t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+            self._conditioning_fingerprint = hash_func.hexdigest()
+        return self._conditioning_fingerprint
+
+    def get_mel_transform(self, n_fft, hop_length, win_length):
+        """Return the cloning mel transform with the given STFT parameters on the model device, built once."""
+        key = (n_fft, hop_length, win_length, self.device)
+        if key not in self._mel_transforms:
+            self._mel_transforms[key] = torchaudio.transforms.MelSpectrogram(
+                n_fft=n_fft,
+                hop_length=hop_length,
+                win_length=win_length,
+                power=2,
+                normalized=False,
+                sample_rate=22050,
+                f_min=0,
+                f_max=8000,
+                n_mels=80,
+                norm="slaney",
+            ).to(self.device)
+        return self._mel_transforms[key]
+
     @torch.inference_mode()
     def get_gpt_cond_latents(self, audio, sr, length: int = 30, chunk_length: int = 6):
         """Compute the conditioning latents for the GPT model from the given audio.
 
+        With the perceiver resampler, the audio is split in chunks of `chunk_length` seconds that are encoded in a
+        single padded batch, and their latents are averaged.
+
         Args:
             audio (tensor): audio tensor.
             sr (int): Sample rate of the audio.
@@ -265,52 +333,42 @@ class Xtts(BaseTTS):
             chunk_length (int): Length of the audio chunks in seconds. When `length == chunk_length`, the whole audio
                 is being used without chunking. It must be < `length`. Defaults to 6.
         """
+        audio = audio.to(self.device)
         if sr != 22050:
             audio = torchaudio.functional.resample(audio, sr, 22050)
         if length > 0:
             audio = audio[:, : 22050 * length]
         if self.args.gpt_use_perceiver_resampler:
-            style_embs = []
-            for i in range(0, audio.shape[1], 22050 * chunk_length):
-                audio_chunk = audio[:, i : i + 22050 * chunk_length]
-
-                # if the chunk is too short ignore it 
-                if audio_chunk.size(-1) < 22050 * 0.33:
-                    continue
-
-                mel_chunk = wav_to_mel_cloning(
-                    audio_chunk,
-                    mel_norms=self.mel_stats.cpu(),
-                    n_fft=2048,
-                    hop_length=256,
-                    win_length=1024,
-                    power=2,
-                    normalized=False,
-                    sample_rate=22050,
-                    f_min=0,
-                    f_max=8000,
-                    n_mels=80,
-                )
-                style_emb = self.gpt.get_style_emb(mel_chunk.to(self.device), None)
-                style_embs.append(style_emb)
+            mel_stft = self.get_mel_transform(n_fft=2048, hop_length=256, win_length=1024)
+            chunk_size = 22050 * chunk_length
+            num_full_chunks = audio.shape[1] // chunk_size
+            # the full chunks are transformed together, the last one alone so its STFT padding is unchanged
+            chunks = []
+            if num_full_chunks > 0:
+                chunks.append(audio[0, : num_full_chunks * chunk_size].reshape(num_full_chunks, chunk_size))
+            last_chunk = audio[:, num_full_chunks * chunk_size :]
+            # if the chunk is too short ignore it
+            if last_chunk.size(-1) >= 22050 * 0.33:
+                chunks.append(last_chunk)
+            mels = [wav_to_mel_cloning(chunk, mel_norms=self.mel_stats, mel_stft=mel_stft) for chunk in chunks]
+
+            mel_lengths = torch.tensor([mel.shape[-1] for mel in mels for _ in range(mel.shape[0])], device=self.device)
+            max_length = mel_lengths.max()
+            mel = torch.cat([F.pad(mel, (0, max_length - mel.shape[-1])) for mel in mels], dim=0)
+            cond_mask = None
+            if (mel_lengths != max_length).any():
+                cond_mask = torch.arange(max_length, device=self.device)[None, :] < mel_lengths[:, None]
+            style_embs = self.gpt.get_style_emb(mel, cond_mask=cond_mask)
 
             # mean style embedding
-            cond_latent = torch.stack(style_embs).mean(dim=0)
+            cond_latent = style_embs.mean(dim=0, keepdim=True)
         else:
             mel = wav_to_mel_cloning(
                 audio,
-                mel_norms=self.mel_stats.cpu(),
-                n_fft=4096,
-                hop_length=1024,
-                win_length=4096,
-                power=2,
-                normalized=False,
-                sample_rate=22050,
-                f_min=0,
-                f_max=8000,
-                n_mels=80,
+                mel_norms=self.mel_stats,
+                mel_stft=self.get_mel_transform(n_fft=4096, hop_length=1024, win_length=4096),
             )
-            cond_latent = self.gpt.get_style_emb(mel.to(self.device))
+            cond_latent = self.gpt.get_style_emb(mel)
         return cond_latent.transpose(1, 2)
 
     @torch.inference_mode()
@@ -322,6 +380,91 @@ class Xtts(BaseTTS):
             .to(self.device)
         )
 
+    @torch.inference_mode()
+    def get_speaker_embeddings_batch(self, audios, sr, batch_size=16):
+        """Compute the speaker embeddings of many audios with padded batches.
+
+        The audios are sorted by length so each batch has little padding, resampled to 16 kHz together and encoded
+        with length masks, so each embedding matches `get_speaker_embedding()` on the audio alone.
+
+        Args:
+            audios (List[Tensor]): Audios of shape (1, T).
+            sr (int): Sample rate of the audios.
+            batch_size (int): Number of audios encoded together. Defaults to 16.
+
+        Returns:
+            Tensor: Speaker embeddings (N, 512, 1) in the order of `audios`.
+        """
+        gcd = math.gcd(sr, 16000)
+        order = sorted(range(len(audios)), key=lambda i: audios[i].shape[-1])
+        embeddings = [None] * len(audios)
+        for start in range(0, len(order), batch_size):
+            batch_ids = order[start : start + batch_size]
+            batch = [audios[i][0].to(self.device) for i in batch_ids]
+            wavs = torchaudio.functional.resample(torch.nn.utils.rnn.pad_sequence(batch, batch_first=True), sr, 16000)
+            lengths = torch.tensor(
+                [math.ceil((16000 // gcd) * wav.shape[-1] / (sr // gcd)) for wav in batch], device=self.device
+            )
+            wavs = wavs[:, : lengths.max()]
+            if (lengths == wavs.shape[-1]).all():
+                lengths = None
+            batch_embeddings = self.hifigan_decoder.speaker_encoder.forward(wavs, l2_norm=True, lengths=lengths)
+            for i, embedding in zip(batch_ids, batch_embeddings):
+                embeddings[i] = embedding
+        return torch.stack(embeddings).unsqueeze(-1)
+
+    def load_references(
+        self, audio_paths, load_sr=22050, max_ref_length=30, librosa_trim_db=None, sound_norm_refs=False, num_workers=8
+    ):
+        """Load reference audio files in a thread pool. See `get_conditioning_latents()` for the arguments.
+
+        Returns:
+            List[Tensor]: Audios of shape (1, T) at `load_sr`, in the order of `audio_paths`.
+        """
+
+        def _load(file_path):
+            audio = load_audio(file_path, load_sr)
+            audio = audio[:, : load_sr * max_ref_length]
+            if sound_norm_refs:
+                audio = (audio / torch.abs(audio).max()) * 0.75
+            if librosa_trim_db is not None:
+                audio = librosa.effects.trim(audio, top_db=librosa_trim_db)[0]
+            return audio
+
+        if len(audio_paths) == 1 or num_workers <= 1:
+            return [_load(file_path) for file_path in audio_paths]
+        with ThreadPoolExecutor(max_workers=min(num_workers, len(audio_paths))) as executor:
+            return list(executor.map(_load, audio_paths))
+
+    @torch.inference_mode()
+    def enroll_speaker(
+        self,
+        audio_paths,
+        max_ref_length=30,
+        librosa_trim_db=None,
+        sound_norm_refs=False,
+        load_sr=22050,
+        batch_size=16,
+        num_workers=8,
+    ):
+        """Compute the speaker embeddings of a bank of reference files.
+
+        Args:
+            audio_paths (List[str]): Paths to the reference audio files.
+            batch_size (int): Number of files encoded together by the speaker encoder. Defaults to 16.
+            num_workers (int): Number of threads decoding the files. Defaults to 8.
+            Other arguments: See `get_conditioning_latents()`.
+
+        Returns:
+            Tuple[Tensor, Tensor]: Speaker embeddings of each file (N, 512, 1) and their average (1, 512, 1), as
+            returned by `get_conditioning_latents()`.
+        """
+        audios = self.load_references(
+            audio_paths, load_sr, max_ref_length, librosa_trim_db, sound_norm_refs, num_workers=num_workers
+        )
+        speaker_embeddings = self.get_speaker_embeddings_batch(audios, load_sr, batch_size=batch_size)
+        return speaker_embeddings, speaker_embeddings.mean(dim=0, keepdim=True)
+
     @torch.inference_mode()
     def get_conditioning_latents(
         self,
@@ -350,22 +493,26 @@ class Xtts(BaseTTS):
         else:
             audio_paths = audio_path
 
-        speaker_embeddings = []
-        audios = []
-        speaker_embedding = None
-        for file_path in audio_paths:
-            audio = load_audio(file_path, load_sr)
-            audio = audio[:, : load_sr * max_ref_length].to(self.device)
-            if sound_norm_refs:
-                audio = (audio / torch.abs(audio).max()) * 0.75
-            if librosa_trim_db is not None:
-                audio = librosa.effects.trim(audio, top_db=librosa_trim_db)[0]
+        cache_key = None
+        if self.speaker_cache is not None:
+            cache_key = self.speaker_cache.make_key(
+                audio_paths,
+                model=self.conditioning_fingerprint(),
+                max_ref_length=max_ref_length,
+                gpt_cond_len=gpt_cond_len,
+                gpt_cond_chunk_len=gpt_cond_chunk_len,
+                librosa_trim_db=librosa_trim_db,
+                sound_norm_refs=sound_norm_refs,
+                load_sr=load_sr,
+            )
+            cached = self.speaker_cache.get(cache_key)
+            if cached is not None:
+                return cached[0].to(self.device), cached[1].to(self.device)
 
-            # compute latents for the decoder
-            speaker_embedding = self.get_speaker_embedding(audio, load_sr)
-            speaker_embeddings.append(speaker_embedding)
+        audios = self.load_references(audio_paths, load_sr, max_ref_length, librosa_trim_db, sound_norm_refs)
 
-            audios.append(audio)
+        # compute latents for the decoder
+        speaker_embedding = self.get_speaker_embeddings_batch(audios, load_sr).mean(dim=0, keepdim=True)
 
         # merge all the audios and compute the latents for the gpt
         full_audio = torch.cat(audios, dim=-1)
@@ -373,10 +520,8 @@ class Xtts(BaseTTS):
             full_audio, load_sr, length=gpt_cond_len, chunk_length=gpt_cond_chunk_len
         )  # [1, 1024, T]
 
-        if speaker_embeddings:
-            speaker_embedding = torch.stack(speaker_embeddings)
-            speaker_embedding = speaker_embedding.mean(dim=0)
-
+        if cache_key is not None:
+            self.speaker_cache.put(cache_key, gpt_cond_latents, speaker_embedding)
         return gpt_cond_latents, speaker_embedding
 
     def synthesize(self, text, config, speaker_wav, language, speaker_id=None, **kwargs):
@@ -499,6 +644,20 @@ class Xtts(BaseTTS):
             **hf_generate_kwargs,
         )
 
+    def get_gpt_latents(self, gpt_cond_latent, text_tokens, gpt_codes):
+        """Compute the latents of `gpt_codes` with a second GPT forward pass, as during training."""
+        expected_output_len = torch.tensor([gpt_codes.shape[-1] * self.gpt.code_stride_len], device=text_tokens.device)
+        text_len = torch.tensor([text_tokens.shape[-1]], device=self.device)
+        return self.gpt(
+            text_tokens,
+            text_len,
+            gpt_codes,
+            expected_output_len,
+            cond_latents=gpt_cond_latent,
+            return_attentions=False,
+            return_latent=True,
+        )
+
     @torch.inference_mode()
     def inference(
         self,
@@ -516,6 +675,7 @@ class Xtts(BaseTTS):
         num_beams=1,
         speed=1.0,
         enable_text_splitting=False,
+        reforward_latents=False,
         **hf_generate_kwargs,
     ):
         language = language.split("-")[0]  # remove the country code
@@ -538,7 +698,9 @@ class Xtts(BaseTTS):
             ), " ❗ XTTS can only generate text with a maximum of 400 tokens."
 
             with torch.no_grad():
-                gpt_codes = self.gpt.generate(
+                # the latents are collected during the decoding, except with beam search
+                return_latents = num_beams == 1 and not reforward_latents
+                gpt_out = self.gpt.generate(
                     cond_latents=gpt_cond_latent,
                     text_inputs=text_tokens,
                     input_tokens=None,
@@ -551,23 +713,15 @@ class Xtts(BaseTTS):
                     length_penalty=length_penalty,
                     repetition_penalty=repetition_penalty,
                     output_attentions=False,
+                    return_latents=return_latents,
                     **hf_generate_kwargs,
                 )
 
-                expected_output_len = torch.tensor(
-                    [gpt_codes.shape[-1] * self.gpt.code_stride_len], device=text_tokens.device
-                )
-
-                text_len = torch.tensor([text_tokens.shape[-1]], device=self.device)
-                gpt_latents = self.gpt(
-                    text_tokens,
-                    text_len,
-                    gpt_codes,
-                    expected_output_len,
-                    cond_latents=gpt_cond_latent,
-                    return_attentions=False,
-                    return_latent=True,
-                )
+                if return_latents:
+                    gpt_codes, gpt_latents = gpt_out
+                else:
+                    gpt_codes = gpt_out
+                    gpt_latents = self.get_gpt_latents(gpt_cond_latent, text_tokens, gpt_codes)
 
                 if length_scale != 1.0:
                     gpt_latents = F.interpolate(
@@ -585,6 +739,250 @@ class Xtts(BaseTTS):
             "speaker_embedding": speaker_embedding,
         }
 
+    def inference_pipelined(
+        self,
+        text,
+        language,
+        gpt_cond_latent,
+        speaker_embedding,
+        # GPT inference
+        temperature=0.75,
+        length_penalty=1.0,
+        repetition_penalty=10.0,
+        top_k=50,
+        top_p=0.85,
+        do_sample=True,
+        num_beams=1,
+        speed=1.0,
+        enable_text_splitting=True,
+        max_pending_sentences=2,
+        reforward_latents=False,
+        **hf_generate_kwargs,
+    ):
+        """Synthesize `text` sentence by sentence, decoding the next sentences while the current one is vocoded.
+
+        The autoregressive decoding runs in a background thread, on its own CUDA stream on GPU, up to
+        `max_pending_sentences` sentences ahead. The HiFi-GAN decoder (and the latent forward pass with
+        `reforward_latents`) run in the calling thread, so they overlap with the decoding of the next sentences, also
+        while the caller holds the generator.
+
+        Args:
+            max_pending_sentences (int): Number of decoded sentences waiting to be vocoded before the decoding pauses.
+                Defaults to 2.
+            reforward_latents (bool): Compute the latents with a second GPT forward pass instead of collecting them
+                during the decoding. Defaults to False.
+            Other arguments: See `inference()`.
+
+        Yields:
+            dict: `text` of the sentence, its `wav` at 24kHz and its `gpt_latents`, in the order of the sentences.
+        """
+        language = language.split("-")[0]  # remove the country code
+        length_scale = 1.0 / max(speed, 0.05)
+        gpt_cond_latent = gpt_cond_latent.to(self.device)
+        speaker_embedding = speaker_embedding.to(self.device)
+        if enable_text_splitting:
+            text = split_sentence(text, language, self.tokenizer.char_limits.get(language, 250))
+        else:
+            text = [text]
+
+        sentences = []
+        for sent in text:
+            sent = sent.strip().lower()
+            text_tokens = torch.IntTensor(self.tokenizer.encode(sent, lang=language)).unsqueeze(0).to(self.device)
+            assert (
+                text_tokens.shape[-1] < self.args.gpt_max_text_tokens
+            ), " ❗ XTTS can only generate text with a maximum of 400 tokens."
+            sentences.append((sent, text_tokens))
+
+        use_cuda = self.device.type == "cuda"
+        return_latents = num_beams == 1 and not reforward_latents
+        decoded = queue.Queue(maxsize=max_pending_sentences)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    decoded.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def _decode():
+            stream = torch.cuda.Stream(self.device) if use_cuda else None
+            try:
+                with torch.inference_mode(), torch.cuda.stream(stream):
+                    for _, text_tokens in sentences:
+                        if stop.is_set():
+                            return
+                        gpt_out = self.gpt.generate(
+                            cond_latents=gpt_cond_latent,
+                            text_inputs=text_tokens,
+                            input_tokens=None,
+                            do_sample=do_sample,
+                            top_p=top_p,
+                            top_k=top_k,
+                            temperature=temperature,
+                            num_return_sequences=self.gpt_batch_size,
+                            num_beams=num_beams,
+                            length_penalty=length_penalty,
+                            repetition_penalty=repetition_penalty,
+                            output_attentions=False,
+                            return_latents=return_latents,
+                            **hf_generate_kwargs,
+                        )
+                        gpt_codes, gpt_latents = gpt_out if return_latents else (gpt_out, None)
+                        event = None
+                        if use_cuda:
+                            event = torch.cuda.Event()
+                            event.record(stream)
+                        _put((gpt_codes, gpt_latents, event))
+            except Exception as e:  # pylint: disable=broad-except
+                _put(e)
+
+        decoder_thread = threading.Thread(target=_decode, daemon=True)
+        decoder_thread.start()
+        try:
+            for sent, text_tokens in sentences:
+                item = decoded.get()
+                if isinstance(item, Exception):
+                    raise item
+                gpt_codes, gpt_latents, event = item
+                with torch.inference_mode():
+                    if event is not None:
+                        torch.cuda.current_stream(self.device).wait_event(event)
+                        for tensor in (gpt_codes, gpt_latents):
+                            if tensor is not None:
+                                tensor.record_stream(torch.cuda.current_stream(self.device))
+
+                    if gpt_latents is None:
+                        gpt_latents = self.get_gpt_latents(gpt_cond_latent, text_tokens, gpt_codes)
+
+                    if length_scale != 1.0:
+                        gpt_latents = F.interpolate(
+                            gpt_latents.transpose(1, 2), scale_factor=length_scale, mode="linear"
+                        ).transpose(1, 2)
+                    wav = self.hifigan_decoder(gpt_latents, g=speaker_embedding)
+
+                yield {
+                    "text": sent,
+                    "wav": wav.cpu().squeeze().numpy(),
+                    "gpt_latents": gpt_latents.cpu().numpy(),
+                }
+        finally:
+            stop.set()
+            decoder_thread.join()
+
+    @torch.inference_mode()
+    def inference_batch(
+        self,
+        texts,
+        languages,
+        gpt_cond_latents,
+        speaker_embeddings,
+        # GPT inference
+        temperature=0.75,
+        length_penalty=1.0,
+        repetition_penalty=10.0,
+        top_k=50,
+        top_p=0.85,
+        do_sample=True,
+        speed=1.0,
+        reforward_latents=False,
+        **hf_generate_kwargs,
+    ):
+        """Synthesize several independent requests with one batched GPT decoding and one HiFi-GAN call.
+
+        Text tokens are padded to the longest request and decoded together, each row stopping on its own stop token.
+        The ragged latents are then padded and vocoded at once. Each text is handled as a single sentence, split long
+        texts beforehand.
+
+        Args:
+            texts (List[str]): Input texts, one per request.
+            languages (str or List[str]): Language of each request or one language for all of them.
+            gpt_cond_latents (Tensor or List[Tensor]): GPT conditioning latents as a `[B, T, C]` tensor or a list of
+                `[1, T, C]` tensors. A single `[1, T, C]` latent is shared by all the requests.
+            speaker_embeddings (Tensor or List[Tensor]): Speaker embeddings as a `[B, C, 1]` tensor or a list of
+                `[1, C, 1]` tensors. A single `[1, C, 1]` embedding is shared by all the requests.
+            reforward_latents (bool): Compute the latents with a second GPT forward pass instead of collecting them
+                during the decoding. Slower, for parity with the training forward. Defaults to False.
+
+        Returns:
+            A list with one dictionary per request, holding the same keys as `inference()`.
+        """
+        batch_size = len(texts)
+        if isinstance(languages, str):
+            languages = [languages] * batch_size
+        length_scale = 1.0 / max(speed, 0.05)
+
+        if isinstance(gpt_cond_latents, (list, tuple)):
+            gpt_cond_latents = torch.cat(gpt_cond_latents, dim=0)
+        if isinstance(speaker_embeddings, (list, tuple)):
+            speaker_embeddings = torch.cat(speaker_embeddings, dim=0)
+        gpt_cond_latents = gpt_cond_latents.to(self.device).expand(batch_size, -1, -1)
+        speaker_embeddings = speaker_embeddings.to(self.device).expand(batch_size, -1, -1)
+
+        text_tokens = []
+        for text, language in zip(texts, languages):
+            language = language.split("-")[0]  # remove the country code
+            tokens = torch.IntTensor(self.tokenizer.encode(text.strip().lower(), lang=language))
+            assert (
+                tokens.shape[-1] < self.args.gpt_max_text_tokens
+            ), " ❗ XTTS can only generate text with a maximum of 400 tokens."
+            text_tokens.append(tokens)
+        text_lengths = torch.tensor([t.shape[-1] for t in text_tokens], device=self.device)
+        text_tokens = torch.nn.utils.rnn.pad_sequence(text_tokens, batch_first=True).to(self.device)
+
+        gpt_out = self.gpt.generate(
+            cond_latents=gpt_cond_latents,
+            text_inputs=text_tokens,
+            text_lengths=text_lengths,
+            do_sample=do_sample,
+            top_p=top_p,
+            top_k=top_k,
+            temperature=temperature,
+            num_return_sequences=1,
+            num_beams=1,
+            length_penalty=length_penalty,
+            repetition_penalty=repetition_penalty,
+            output_attentions=False,
+            return_latents=not reforward_latents,
+            **hf_generate_kwargs,
+        )
+        if reforward_latents:
+            gpt_codes = gpt_out
+            gpt_latents = self.gpt.get_latents(gpt_cond_latents, text_tokens, gpt_codes, text_lengths)
+        else:
+            gpt_codes, gpt_latents = gpt_out
+        # keep the stop token of each row, as `inference()` does
+        is_stop = gpt_codes == self.gpt.stop_audio_token
+        code_lengths = torch.where(is_stop.any(dim=1), is_stop.int().argmax(dim=1) + 1, gpt_codes.shape[-1])
+
+        gpt_latents_list = []
+        for latents, code_length in zip(gpt_latents, code_lengths.tolist()):
+            latents = latents[None, :code_length]
+            if length_scale != 1.0:
+                latents = F.interpolate(latents.transpose(1, 2), scale_factor=length_scale, mode="linear").transpose(
+                    1, 2
+                )
+            gpt_latents_list.append(latents)
+
+        # vocode the ragged latents at once and cut each waveform back to its own length
+        latent_lengths = [latents.shape[1] for latents in gpt_latents_list]
+        padded_latents = torch.nn.utils.rnn.pad_sequence([latents[0] for latents in gpt_latents_list], batch_first=True)
+        wavs = self.hifigan_decoder(padded_latents, g=speaker_embeddings).squeeze(1)
+        samples_per_latent = wavs.shape[-1] / padded_latents.shape[1]
+
+        return [
+            {
+                "wav": wav[: int(length * samples_per_latent)].cpu().numpy(),
+                "gpt_latents": latents.cpu().numpy(),
+                "speaker_embedding": speaker_embedding[None],
+            }
+            for wav, latents, length, speaker_embedding in zip(
+                wavs, gpt_latents_list, latent_lengths, speaker_embeddings
+            )
+        ]
+
     def handle_chunks(self, wav_gen, wav_gen_prev, wav_overlap, overlap_len):
         """Handle chunk formatting in streaming mode"""
         wav_chunk = wav_gen[:-overlap_len]
@@ -620,6 +1018,9 @@ class Xtts(BaseTTS):
         # Streaming
         stream_chunk_size=20,
         overlap_wav_len=1024,
+        vocoder_context_len=24,
+        stream_policy=None,
+        stream_metrics=None,
         # GPT inference
         temperature=0.75,
         length_penalty=1.0,
@@ -631,6 +1032,25 @@ class Xtts(BaseTTS):
         enable_text_splitting=False,
         **hf_generate_kwargs,
     ):
+        """Stream the speech of `text` in audio chunks of about `stream_chunk_size` GPT tokens.
+
+        Args:
+            stream_chunk_size (int): Number of GPT tokens vocoded per chunk. Defaults to 20.
+            overlap_wav_len (int): Number of samples cross-faded between chunks. Defaults to 1024.
+            vocoder_context_len (int): Number of latents of the previous chunks vocoded again as left context of each
+                chunk. It bounds the cost of a chunk. If None, the whole history is vocoded for every chunk.
+                Defaults to 24.
+            stream_policy (StreamingPolicy, optional): Chunk sizes and cross-fade lengths, e.g. a small first chunk
+                growing up to a cap. Defaults to fixed chunks of `stream_chunk_size` tokens cross-faded over
+                `overlap_wav_len` samples.
+            stream_metrics (StreamMetrics, optional): Filled in with the time to first audio and real-time factor of
+                the stream as it is consumed.
+            Other arguments: See `inference()`.
+
+        Yields:
+            Tensor: audio chunks at 24kHz.
+        """
+        start_time = time.perf_counter()
         language = language.split("-")[0]  # remove the country code
         length_scale = 1.0 / max(speed, 0.05)
         gpt_cond_latent = gpt_cond_latent.to(self.device)
@@ -639,6 +1059,10 @@ class Xtts(BaseTTS):
             text = split_sentence(text, language, self.tokenizer.char_limits.get(language, 250))
         else:
             text = [text]
+        if stream_policy is None:
+            stream_policy = StreamingPolicy.fixed(stream_chunk_size, overlap_wav_len)
+        # chunks are counted over the whole stream, only its first chunk is small
+        num_chunks = 0
 
         for sent in text:
             sent = sent.strip().lower()
@@ -667,32 +1091,43 @@ class Xtts(BaseTTS):
                 **hf_generate_kwargs,
             )
 
-            last_tokens = []
-            all_latents = []
-            wav_gen_prev = None
-            wav_overlap = None
+            vocoder = StreamingVocoder(
+                self.hifigan_decoder,
+                speaker_embedding,
+                context_len=vocoder_context_len,
+                overlap_len=stream_policy.max_overlap_len,
+                length_scale=length_scale,
+                overlap_ratio=stream_policy.overlap_ratio,
+            )
+            new_latents = []
             is_end = False
 
             while not is_end:
+                resume_time = time.perf_counter()
                 try:
-                    x, latent = next(gpt_generator)
-                    last_tokens += [x]
-                    all_latents += [latent]
+                    _, latent = next(gpt_generator)
+                    new_latents += [latent]
                 except StopIteration:
                     is_end = True
 
-                if is_end or (stream_chunk_size > 0 and len(last_tokens) >= stream_chunk_size):
-                    gpt_latents = torch.cat(all_latents, dim=0)[None, :]
-                    if length_scale != 1.0:
-                        gpt_latents = F.interpolate(
-                            gpt_latents.transpose(1, 2), scale_factor=length_scale, mode="linear"
-                        ).transpose(1, 2)
-                    wav_gen = self.hifigan_decoder(gpt_latents, g=speaker_embedding.to(self.device))
-                    wav_chunk, wav_gen_prev, wav_overlap = self.handle_chunks(
-                        wav_gen.squeeze(), wav_gen_prev, wav_overlap, overlap_wav_len
-                    )
-                    last_tokens = []
+                chunk_size = stream_policy.chunk_size(num_chunks)
+                if is_end or (chunk_size > 0 and len(new_latents) >= chunk_size):
+                    gpt_latents = torch.cat(new_latents, dim=0)[None, :] if new_latents else gpt_cond_latent[:, :0]
+                    wav_chunk = vocoder(gpt_latents, is_end=is_end)
+                    new_latents = []
+                    num_chunks += 1
+                    if stream_metrics is not None:
+                        if wav_chunk.is_cuda:
+                            torch.cuda.synchronize(wav_chunk.device)
+                        stream_metrics.add_chunk(
+                            wav_chunk.shape[0],
+                            self.args.output_sample_rate,
+                            start_time,
+                            time.perf_counter() - resume_time,
+                        )
                     yield wav_chunk
+                elif stream_metrics is not None:
+                    stream_metrics.processing_time += time.perf_counter() - resume_time
 
     def forward(self):
         raise NotImplementedError(
@@ -774,6 +1209,7 @@ class Xtts(BaseTTS):
         self.init_models()
 
         checkpoint = self.get_compatible_checkpoint_state_dict(model_path)
+        self._conditioning_fingerprint = None
 
         # deal with v1 and v1.1. V1 has the init_gpt_for_inference keys, v1.1 do not
         try:
@@ -785,7 +1221,9 @@ class Xtts(BaseTTS):
 
         if eval:
             self.hifigan_decoder.eval()
-            self.gpt.init_gpt_for_inference(kv_cache=self.args.kv_cache, use_deepspeed=use_deepspeed)
+            self.gpt.init_gpt_for_inference(
+                kv_cache=self.args.kv_cache, use_deepspeed=use_deepspeed, static_cache=self.args.static_kv_cache
+            )
             self.gpt.eval()
 
     def train_step(self):
@@ -199,3 +199,153 @@ class BucketBatchSampler(BatchSampler):
         if self.drop_last:
             return len(self.sampler) // self.batch_size
         return math.ceil(len(self.sampler) / self.batch_size)
+
+
+class LanguageBucketBatchSampler(Sampler):
+    """Batches of samples of similar length, balanced across languages.
+
+    Each batch holds samples of a single language, drawn uniformly at random like `XTTSDataset` does without a
+    sampler, so every language gets the same share of the batches whatever its size. Within a language, the samples are
+    shuffled, sorted by length in buckets of `bucket_size` samples and cut into batches, so a batch pads its samples to
+    a similar length. The batches are made of up to `batch_size` samples, and of no more samples than fit in the given
+    budgets of padded lengths, so the memory use of a batch stays roughly constant whatever the length of its samples.
+
+    Args:
+        wav_lengths (list): number of audio samples of each sample.
+        text_lengths (list): number of text tokens of each sample.
+        languages (list): language of each sample.
+        batch_size (int): maximum number of samples of a batch. If None, only the budgets limit the batches.
+        max_tokens (int): maximum number of padded GPT tokens (text tokens + audio codes) of a batch. Defaults to None.
+        max_wav_length (int): maximum number of padded audio samples of a batch. Defaults to None.
+        max_text_tokens (int): maximum number of padded text tokens of a batch. Defaults to None.
+        code_stride_len (int): number of audio samples per audio code. Defaults to 1024.
+        bucket_size (int): number of samples sorted together. Defaults to 2000.
+        num_samples (int): number of samples of an epoch. Defaults to the number of samples.
+        seed (int): seed of the epochs, epoch `i` uses `seed + i`. Defaults to 0.
+        balance_languages (bool): if False, an epoch is every sample exactly once, in batches of a single language
+            shuffled together, so the languages are seen in proportion to their size. `num_samples` is then ignored.
+            Defaults to True.
+        num_replicas (int): number of distributed processes. Every process makes the same batches from the seed and
+            takes one out of `num_replicas`, so the processes get disjoint, equally long and language-balanced shards of
+            the epoch. Defaults to 1.
+        rank (int): rank of the process. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        wav_lengths,
+        text_lengths,
+        languages,
+        batch_size=None,
+        max_tokens=None,
+        max_wav_length=None,
+        max_text_tokens=None,
+        code_stride_len=1024,
+        bucket_size=2000,
+        num_samples=None,
+        seed=0,
+        balance_languages=True,
+        num_replicas=1,
+        rank=0,
+    ):
+        super().__init__(None)
+        assert (
+            batch_size is not None or max_tokens is not None or max_wav_length is not None or max_text_tokens is not None
+        ), "Set either batch_size or a batch budget."
+        self.wav_lengths = list(wav_lengths)
+        self.code_lengths = [math.ceil(wav_len / code_stride_len) for wav_len in wav_lengths]
+        self.text_lengths = list(text_lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.max_wav_length = max_wav_length
+        self.max_text_tokens = max_text_tokens
+        self.bucket_size = bucket_size
+        self.num_samples = len(self.code_lengths) if num_samples is None else num_samples
+        self.seed = seed
+        self.balance_languages = balance_languages
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        # batches of the next epoch skipped once, to continue an interrupted epoch
+        self.start_batch = 0
+        self._batches = None
+
+        self.language_indices = {}
+        for idx, lang in enumerate(languages):
+            self.language_indices.setdefault(lang, []).append(idx)
+        self.languages = sorted(self.language_indices)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def fits(self, batch_size, max_wav, max_codes, max_text):
+        """Whether a batch of `batch_size` samples padded to the given lengths is within the batch size and budgets."""
+        return (
+            (self.batch_size is None or batch_size <= self.batch_size)
+            and (self.max_tokens is None or batch_size * (max_codes + max_text) <= self.max_tokens)
+            and (self.max_wav_length is None or batch_size * max_wav <= self.max_wav_length)
+            and (self.max_text_tokens is None or batch_size * max_text <= self.max_text_tokens)
+        )
+
+    def make_batches(self, indices, rng):
+        """Cut the `indices` of a language into batches of samples of similar length."""
+        indices = list(indices)
+        rng.shuffle(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(
+                indices[start : start + self.bucket_size], key=lambda i: (self.code_lengths[i], self.text_lengths[i])
+            )
+            batch, max_wav, max_codes, max_text = [], 0, 0, 0
+            for idx in bucket:
+                new_max_wav = max(max_wav, self.wav_lengths[idx])
+                new_max_codes = max(max_codes, self.code_lengths[idx])
+                new_max_text = max(max_text, self.text_lengths[idx])
+                if batch and not self.fits(len(batch) + 1, new_max_wav, new_max_codes, new_max_text):
+                    batches.append(batch)
+                    batch = []
+                    new_max_wav, new_max_codes = self.wav_lengths[idx], self.code_lengths[idx]
+                    new_max_text = self.text_lengths[idx]
+                batch.append(idx)
+                max_wav, max_codes, max_text = new_max_wav, new_max_codes, new_max_text
+            if batch:
+                batches.append(batch)
+        rng.shuffle(batches)
+        return batches
+
+    def get_batches(self):
+        """Batches of the current epoch, the same for a given seed and epoch."""
+        if self._batches is None:
+            rng = random.Random(self.seed + self.epoch)
+            self._batches = []
+            if self.balance_languages:
+                queues = {lang: [] for lang in self.languages}
+                num_samples = 0
+                while num_samples < self.num_samples:
+                    lang = rng.choice(self.languages)
+                    if not queues[lang]:
+                        queues[lang] = self.make_batches(self.language_indices[lang], rng)
+                    batch = queues[lang].pop()
+                    self._batches.append(batch)
+                    num_samples += len(batch)
+            else:
+                for lang in self.languages:
+                    self._batches.extend(self.make_batches(self.language_indices[lang], rng))
+                rng.shuffle(self._batches)
+        return self._batches
+
+    def get_rank_batches(self):
+        """Batches of the current epoch for this process, the trailing batches that cannot be shared are dropped."""
+        batches = self.get_batches()
+        num_batches = len(batches) // self.num_replicas
+        return batches[self.rank :: self.num_replicas][:num_batches]
+
+    def __iter__(self):
+        batches = self.get_rank_batches()[self.start_batch :]
+        self.start_batch = 0
+        self.set_epoch(self.epoch + 1)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.get_rank_batches())
@@ -2,87 +2,97 @@
 import json
 import os
 import argparse
-from pathlib import Path
-from collections import defaultdict
-import re
-
-def extract_sinhala_vocab(metadata_path, vocab_size=2500):
-    """Extract unique Sinhala characters and BPE pairs from metadata."""
-    
-    characters = set()
-    texts = []
-    
-    # Read metadata
+
+from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+
+from TTS.tts.layers.xtts.tokenizer import sinhala_cleaners
+
+# special tokens of the XTTS tokenizer, [STOP], [UNK] and [SPACE] keep ids 0, 1 and 2
+SPECIAL_TOKENS = ["[STOP]", "[UNK]", "[SPACE]", "[START]", "[si]"]
+
+
+def read_texts(metadata_path):
+    """Yield the cleaned text column of a coqui formatted metadata file."""
     with open(metadata_path, 'r', encoding='utf-8') as f:
         for line in f:
             line = line.strip()
             if not line:
                 continue
             parts = line.split('|')
-            if len(parts) >= 2:
-                text = parts  # Second field is text
-                texts.append(text)
-                # Extract all unique characters
-                for char in text:
-                    characters.add(char)
-    
-    # Start with character-level tokens
-    vocab = {char: idx for idx, char in enumerate(sorted(characters))}
-    vocab["[UNK]"] = len(vocab)
-    vocab["[PAD]"] = len(vocab)
-    vocab["[START]"] = len(vocab)
-    vocab["[STOP]"] = len(vocab)
-    vocab["[SPACE]"] = len(vocab)
-    
-    print(f"Character-level vocabulary size: {len(vocab)}")
-    
-    # Simple BPE: iteratively merge frequent pairs
-    texts_str = ' '.join(texts)
-    pair_freq = defaultdict(int)
-    current_vocab_size = len(vocab)
-    
-    # Build BPE tokens up to vocab_size
-    iteration = 0
-    while current_vocab_size < vocab_size and iteration < 1000:
-        # Count adjacent character pairs
-        pair_freq.clear()
-        tokens = list(texts_str)
-        
-        i = 0
-        while i < len(tokens) - 1:
-            pair = (tokens[i], tokens[i+1])
-            pair_freq[pair] += 1
-            i += 1
-        
-        if not pair_freq:
-            break
-        
-        # Get most frequent pair
-        best_pair = max(pair_freq, key=pair_freq.get)
-        new_token = best_pair + best_pair
-        
-        # Add to vocabulary
-        vocab[new_token] = current_vocab_size
-        current_vocab_size += 1
-        
-        # Merge in text
-        texts_str = texts_str.replace(best_pair + best_pair, new_token)
-        
-        iteration += 1
-        if iteration % 100 == 0:
-            print(f"BPE iteration {iteration}: vocab_size={current_vocab_size}")
-    
-    print(f"Final vocabulary size: {len(vocab)}")
-    return vocab
-
-def save_vocab(vocab, output_path):
-    """Save vocabulary to JSON."""
+            if len(parts) < 2 or parts[0] == "audio_file":
+                continue
+            # clean the text the same way VoiceBpeTokenizer.encode does for "si"
+            yield sinhala_cleaners(parts[1])
+
+
+def extract_sinhala_vocab(metadata_path, vocab_size=2500, min_frequency=2):
+    """Train a byte-pair encoding tokenizer on the Sinhala texts of the metadata.
+
+    The tokenizer uses the same model and pre-tokenizer as the XTTS vocab.json, so
+    the saved file can be loaded directly by VoiceBpeTokenizer.
+    """
+    tokenizer = Tokenizer(models.BPE(unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        min_frequency=min_frequency,
+        special_tokens=SPECIAL_TOKENS,
+        show_progress=False,
+    )
+    tokenizer.train_from_iterator(read_texts(metadata_path), trainer=trainer)
+
+    print(f"Trained vocabulary size: {tokenizer.get_vocab_size()}")
+    return tokenizer
+
+
+def extend_vocab(tokenizer, base_vocab_path):
+    """Append the tokens and merges of `tokenizer` missing from the base XTTS vocab.
+
+    The ids of the base vocab are kept, so the text embeddings of a pretrained GPT
+    checkpoint still line up and only the new rows have to be learned.
+    """
+    with open(base_vocab_path, 'r', encoding='utf-8') as f:
+        base = json.load(f)
+    new = json.loads(tokenizer.to_str())
+
+    vocab = base["model"]["vocab"]
+    added_ids = {token["id"] for token in base["added_tokens"]}
+    added_contents = {token["content"] for token in base["added_tokens"]}
+    next_id = max(max(vocab.values()), max(added_ids)) + 1
+
+    # special tokens the base vocab does not have yet, e.g. the language token
+    for token in new["added_tokens"]:
+        if token["content"] not in added_contents and token["content"] not in vocab:
+            base["added_tokens"].append(dict(token, id=next_id))
+            vocab[token["content"]] = next_id
+            next_id += 1
+
+    for token, _ in sorted(new["model"]["vocab"].items(), key=lambda item: item[1]):
+        if token not in vocab and token not in added_contents:
+            vocab[token] = next_id
+            next_id += 1
+
+    # new merges get a lower priority than the base ones, which never involve Sinhala characters
+    merges = base["model"]["merges"]
+    known_merges = {tuple(m.split(" ")) if isinstance(m, str) else tuple(m) for m in merges}
+    as_string = bool(merges) and isinstance(merges[0], str)
+    for merge in new["model"]["merges"]:
+        pair = tuple(merge.split(" ")) if isinstance(merge, str) else tuple(merge)
+        if pair not in known_merges:
+            merges.append(" ".join(pair) if as_string else list(pair))
+            known_merges.add(pair)
+
+    tokenizer = Tokenizer.from_str(json.dumps(base, ensure_ascii=False))
+    print(f"Extended vocabulary size: {tokenizer.get_vocab_size()}")
+    return tokenizer
+
+
+def save_vocab(tokenizer, output_path):
+    """Save the tokenizer as a vocab.json loadable by VoiceBpeTokenizer."""
     os.makedirs(output_path, exist_ok=True)
     vocab_path = os.path.join(output_path, 'vocab.json')
-    
-    with open(vocab_path, 'w', encoding='utf-8') as f:
-        json.dump(vocab, f, ensure_ascii=False, indent=2)
-    
+    tokenizer.save(vocab_path)
+
     print(f"Vocabulary saved to: {vocab_path}")
     return vocab_path
 
@@ -91,11 +101,20 @@ if __name__ == "__main__":
     parser.add_argument("--metadata_path", required=True, help="Path to metadata_train.csv")
     parser.add_argument("--output_path", default="checkpoints/", help="Output directory")
     parser.add_argument("--vocab_size", type=int, default=2500, help="Target vocabulary size")
-    
+    parser.add_argument("--min_frequency", type=int, default=2, help="Minimum frequency of a merged pair")
+    parser.add_argument(
+        "--base_vocab",
+        default=None,
+        help="XTTS vocab.json to extend instead of creating a standalone vocabulary",
+    )
+
     args = parser.parse_args()
-    
-    vocab = extract_sinhala_vocab(args.metadata_path, args.vocab_size)
-    save_vocab(vocab, args.output_path)
-    
+
+    tokenizer = extract_sinhala_vocab(args.metadata_path, args.vocab_size, args.min_frequency)
+    if args.base_vocab:
+        tokenizer = extend_vocab(tokenizer, args.base_vocab)
+    save_vocab(tokenizer, args.output_path)
+
     print("\n✓ Sinhala vocabulary created successfully!")
-    print(f"  Total tokens: {len(vocab)}")
+    print(f"  Total tokens: {tokenizer.get_vocab_size()}")
+    print(f"  Set gpt_number_text_tokens to {tokenizer.get_vocab_size()} in the model args")
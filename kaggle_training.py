@@ -102,26 +102,28 @@ print("✅ All model files downloaded!")
     print("✅ Model files downloaded!")
 
 def train_dvae():
-    """Train DVAE model"""
+    """Train DVAE model and return the path of the best DVAE checkpoint"""
     print("Starting DVAE training...")
-    
-    cmd = [
-        sys.executable, "train_dvae_xtts.py",
-        "--output_path", "checkpoints",
-        "--train_csv_path", "datasets/sinhala/metadata_train.csv",
-        "--eval_csv_path", "datasets/sinhala/metadata_eval.csv", 
-        "--language", "si",  # Sinhala language code
-        "--lr", "5e-6",
-        "--num_epochs", "5",
-        "--batch_size", "512"
-    ]
-    
-    print(f"Running command: {' '.join(cmd)}")
-    subprocess.run(cmd, check=True)
+    import torch
+    from train_dvae_xtts import train
+
+    dvae_checkpoint = train(
+        output_path="checkpoints",
+        train_csv_path="datasets/sinhala/metadata_train.csv",
+        eval_csv_path="datasets/sinhala/metadata_eval.csv",
+        language="si",  # Sinhala language code
+        lr=5e-6,
+        num_epochs=5,
+        batch_size=512,
+    )
+    # release the cached GPU memory for the GPT training subprocess
+    torch.cuda.empty_cache()
+
     print("✅ DVAE training completed!")
+    return dvae_checkpoint
 
-def train_gpt():
-    """Train GPT model"""
+def train_gpt(dvae_checkpoint=None):
+    """Train GPT model, computing the audio codes with `dvae_checkpoint` if given"""
     print("Starting GPT training...")
     
     cmd = [
@@ -137,6 +139,8 @@ def train_gpt():
         "--lr", "5e-6",
         "--save_step", "5000"
     ]
+    if dvae_checkpoint:
+        cmd += ["--dvae_checkpoint", dvae_checkpoint]
     
     print(f"Running command: {' '.join(cmd)}")
     subprocess.run(cmd, check=True)
@@ -161,13 +165,13 @@ def main():
         print("\n" + "="*50)
         print("STEP 4: Training DVAE Model")
         print("="*50)
-        train_dvae()
+        dvae_checkpoint = train_dvae()
         
         # Step 5: Train GPT
         print("\n" + "="*50)
         print("STEP 5: Training GPT Model")
         print("="*50)
-        train_gpt()
+        train_gpt(dvae_checkpoint)
         
         print("\n🎉 Training completed successfully!")
         print("Your finetuned model is saved in the 'checkpoints' directory")
@@ -0,0 +1,68 @@
+import os
+import argparse
+
+from TTS.config.shared_configs import BaseDatasetConfig
+from TTS.tts.datasets import load_tts_samples
+from TTS.tts.layers.xtts.trainer.audio_shards import AudioShardStore
+
+
+def create_audio_shards_parser():
+    parser = argparse.ArgumentParser(description="Pack the decoded and resampled audio of a dataset in shard files")
+
+    parser.add_argument("--output_path", type=str, required=True,
+                        help="Directory of the shards, to pass as --audio_shards_path to the trainers")
+    parser.add_argument("--metadatas", nargs='+', type=str, required=True,
+                        help="train_csv_path,eval_csv_path,language")
+    parser.add_argument("--sample_rate", type=int, default=22050,
+                        help="Sample rate of the training audio")
+    parser.add_argument("--shard_size", type=int, default=1024,
+                        help="Size of a shard in MB")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16"],
+                        help="Sample type, float16 halves the size of the shards but reads are no longer zero-copy")
+    parser.add_argument("--num_workers", type=int, default=8,
+                        help="Number of decoding threads")
+
+    return parser
+
+
+def pack_audio_shards(metadatas, output_path, sample_rate=22050, shard_size=1024, dtype="float32", num_workers=8):
+    DATASETS_CONFIG_LIST = []
+    for metadata in metadatas:
+        train_csv, eval_csv, language = metadata.split(",")
+
+        config_dataset = BaseDatasetConfig(
+            formatter="coqui",
+            dataset_name="ft_dataset",
+            path=os.path.dirname(train_csv),
+            meta_file_train=os.path.basename(train_csv),
+            meta_file_val=os.path.basename(eval_csv),
+            language=language,
+        )
+
+        DATASETS_CONFIG_LIST.append(config_dataset)
+
+    # audio of both splits
+    train_samples, eval_samples = load_tts_samples(DATASETS_CONFIG_LIST, eval_split=True, eval_split_max_size=None)
+
+    AudioShardStore.pack(
+        output_path,
+        train_samples + eval_samples,
+        sample_rate,
+        shard_size=shard_size * 2**20,
+        dtype=dtype,
+        num_workers=num_workers,
+    )
+
+
+if __name__ == "__main__":
+    parser = create_audio_shards_parser()
+    args = parser.parse_args()
+
+    pack_audio_shards(
+        metadatas=args.metadatas,
+        output_path=args.output_path,
+        sample_rate=args.sample_rate,
+        shard_size=args.shard_size,
+        dtype=args.dtype,
+        num_workers=args.num_workers,
+    )
@@ -0,0 +1,87 @@
+import os
+import argparse
+
+import torch
+
+from TTS.config.shared_configs import BaseDatasetConfig
+from TTS.tts.datasets import load_tts_samples
+from TTS.tts.layers.tortoise.arch_utils import TorchMelSpectrogram
+from TTS.tts.layers.xtts.dvae import DiscreteVAE
+from TTS.tts.layers.xtts.trainer.dvae_codes import DVAECodeStore
+
+
+def create_dvae_codes_parser():
+    parser = argparse.ArgumentParser(description="Precompute the DVAE codes of a dataset for GPT training")
+
+    parser.add_argument("--output_path", type=str, required=True,
+                        help="Directory of the DVAE code store, to pass as --dvae_codes_path to train_gpt_xtts.py")
+    parser.add_argument("--metadatas", nargs='+', type=str, required=True,
+                        help="train_csv_path,eval_csv_path,language")
+    parser.add_argument("--dvae_checkpoint", type=str, required=True,
+                        help="Path to the DVAE checkpoint (dvae.pth)")
+    parser.add_argument("--mel_norm_file", type=str, required=True,
+                        help="Path to the mel stats (mel_stats.pth)")
+    parser.add_argument("--num_audio_tokens", type=int, default=1026,
+                        help="gpt_num_audio_tokens of the GPT")
+    parser.add_argument("--sample_rate", type=int, default=22050,
+                        help="Sample rate of the training audio")
+    parser.add_argument("--dvae_sample_rate", type=int, default=22050,
+                        help="Sample rate of the DVAE")
+
+    return parser
+
+
+def precompute_dvae_codes(metadatas, output_path, dvae_checkpoint, mel_norm_file, num_audio_tokens=1026, sample_rate=22050, dvae_sample_rate=22050):
+    DATASETS_CONFIG_LIST = []
+    for metadata in metadatas:
+        train_csv, eval_csv, language = metadata.split(",")
+
+        config_dataset = BaseDatasetConfig(
+            formatter="coqui",
+            dataset_name="ft_dataset",
+            path=os.path.dirname(train_csv),
+            meta_file_train=os.path.basename(train_csv),
+            meta_file_val=os.path.basename(eval_csv),
+            language=language,
+        )
+
+        DATASETS_CONFIG_LIST.append(config_dataset)
+
+    # codes of both splits
+    train_samples, eval_samples = load_tts_samples(DATASETS_CONFIG_LIST, eval_split=True, eval_split_max_size=None)
+
+    # same DVAE as GPTTrainer
+    dvae = DiscreteVAE(
+        channels=80,
+        normalization=None,
+        positional_dims=1,
+        num_tokens=num_audio_tokens - 2,
+        codebook_dim=512,
+        hidden_dim=512,
+        num_resnet_blocks=3,
+        kernel_size=3,
+        num_layers=2,
+        use_transposed_convs=False,
+    )
+    dvae.load_state_dict(torch.load(dvae_checkpoint, map_location=torch.device("cpu")), strict=False)
+    mel_extractor = TorchMelSpectrogram(mel_norm_file=mel_norm_file, sampling_rate=dvae_sample_rate)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    DVAECodeStore.build(
+        output_path, train_samples + eval_samples, dvae, mel_extractor, sample_rate, dvae_sample_rate, device=device
+    )
+
+
+if __name__ == "__main__":
+    parser = create_dvae_codes_parser()
+    args = parser.parse_args()
+
+    precompute_dvae_codes(
+        metadatas=args.metadatas,
+        output_path=args.output_path,
+        dvae_checkpoint=args.dvae_checkpoint,
+        mel_norm_file=args.mel_norm_file,
+        num_audio_tokens=args.num_audio_tokens,
+        sample_rate=args.sample_rate,
+        dvae_sample_rate=args.dvae_sample_rate,
+    )
@@ -0,0 +1,21 @@
+import unittest
+
+from TTS.tts.layers.xtts.streaming import StreamingPolicy
+
+
+class StreamingPolicyTest(unittest.TestCase):
+    def test_chunk_size_grows_up_to_the_cap(self):
+        policy = StreamingPolicy(first_chunk_size=4, growth_factor=2.0, max_chunk_size=40)
+        self.assertEqual([policy.chunk_size(i) for i in range(6)], [4, 8, 16, 32, 40, 40])
+
+    def test_chunk_size_of_long_streams(self):
+        policy = StreamingPolicy()
+        self.assertEqual(policy.chunk_size(5000), policy.max_chunk_size)
+        policy = StreamingPolicy(first_chunk_size=4, growth_factor=1.5, max_chunk_size=41)
+        self.assertEqual(policy.chunk_size(5000), 41)
+
+    def test_fixed_chunk_size(self):
+        policy = StreamingPolicy.fixed(20)
+        self.assertEqual(policy.chunk_size(0), 20)
+        self.assertEqual(policy.chunk_size(5000), 20)
+        self.assertEqual(StreamingPolicy.fixed(0).chunk_size(5000), 0)
@@ -10,11 +10,14 @@ from torch.nn.utils import clip_grad_norm_
 from tqdm import tqdm
 from TTS.tts.datasets import load_tts_samples
 from TTS.config.shared_configs import BaseDatasetConfig
+from TTS.utils.samplers import LanguageBucketBatchSampler
 
 from dataclasses import dataclass, field
 from typing import Optional
 import os
 import datetime
+import glob
+import time
 from transformers import HfArgumentParser
 
 @dataclass
@@ -47,17 +50,121 @@ class DVAETrainerArgs:
     batch_size: Optional[int] = field(
         default=512,
     )
+    audio_shards_path: Optional[str] = field(
+        default="",
+        metadata={"help": "Audio packed with pack_audio_shards.py, read instead of the audio files"},
+    )
+    manifest_path: Optional[str] = field(
+        default="",
+        metadata={"help": "JSON file caching the audio lengths used to filter the samples"},
+    )
+    crop_seconds: Optional[float] = field(
+        default=4.0,
+        metadata={"help": "Clips are randomly cropped to this duration instead of padding the batch to the longest clip, 0 disables it"},
+    )
+    max_batch_seconds: Optional[float] = field(
+        default=0,
+        metadata={"help": "Maximum padded audio seconds of a batch, on top of batch_size, 0 disables it"},
+    )
+    bucket_size: Optional[int] = field(
+        default=2000,
+        metadata={"help": "Number of clips sorted together by length to make batches of similar length"},
+    )
+    grad_accum_steps: Optional[int] = field(
+        default=1,
+        metadata={"help": "Number of batches accumulated per optimizer step"},
+    )
+    precision: Optional[str] = field(
+        default="fp32",
+        metadata={"help": "Training precision: fp32, or fp16/bf16 mixed precision (CUDA only)"},
+    )
+    save_step: Optional[int] = field(
+        default=1000,
+        metadata={"help": "Save a resumable checkpoint every save_step optimizer steps"},
+    )
+    print_step: Optional[int] = field(
+        default=50,
+        metadata={"help": "Print the average losses and the throughput every print_step optimizer steps"},
+    )
+    keep_checkpoints: Optional[int] = field(
+        default=2,
+        metadata={"help": "Number of step checkpoints kept"},
+    )
+    continue_path: Optional[str] = field(
+        default="",
+        metadata={"help": "Checkpoint directory of a previous run to continue from its last checkpoint"},
+    )
+
+
+
+class ThroughputLogger:
+    """Running averages of the training losses and throughput, printed every `print_step` optimizer steps.
+
+    The losses are summed on the device and read once per print, so the training steps are not synchronized with the
+    host.
+    """
+
+    def __init__(self, print_step, sample_rate):
+        self.print_step = print_step
+        self.sample_rate = sample_rate
+        self.reset()
+
+    def reset(self):
+        self.loss_sums = {}
+        self.num_batches = 0
+        self.num_samples = 0
+        self.num_audio_samples = 0
+        self.start_time = time.perf_counter()
 
+    def update(self, losses, num_samples, num_audio_samples):
+        for k, v in losses.items():
+            self.loss_sums[k] = self.loss_sums.get(k, 0) + v.detach()
+        self.num_batches += 1
+        self.num_samples += num_samples
+        self.num_audio_samples += num_audio_samples
 
+    def log(self, epoch, step):
+        if step % self.print_step != 0 or self.num_batches == 0:
+            return
+        elapsed = time.perf_counter() - self.start_time
+        losses = " ".join(f"{k}: {(v / self.num_batches).item():.5f}" for k, v in self.loss_sums.items())
+        stats = f"{self.num_samples / elapsed:.1f} samples/s, {self.num_audio_samples / self.sample_rate / elapsed:.1f} audio s/s"
+        if torch.cuda.is_available():
+            stats += f", peak GPU memory: {torch.cuda.max_memory_allocated() / 2**30:.2f} GB"
+        print(f"epoch: {epoch} step: {step} | {losses} | {stats}")
+        self.reset()
 
-def train(output_path, train_csv_path, eval_csv_path="", language="en", lr=5e-6, num_epochs=5, batch_size=512):
+
+def find_last_checkpoint(checkpoints_path):
+    """Path of the step checkpoint with the highest step in `checkpoints_path`, None if there is none."""
+    checkpoints = glob.glob(os.path.join(checkpoints_path, "checkpoint_*.pth"))
+    if not checkpoints:
+        return None
+    return max(checkpoints, key=lambda path: int(os.path.basename(path)[len("checkpoint_") : -len(".pth")]))
+
+
+def save_checkpoint(checkpoints_path, state, keep_checkpoints=2):
+    """Save the step checkpoint `state` and delete all but the `keep_checkpoints` last ones."""
+    checkpoint_path = os.path.join(checkpoints_path, f"checkpoint_{state['step']}.pth")
+    # write then rename so an interrupted save never leaves a truncated checkpoint
+    torch.save(state, checkpoint_path + ".tmp")
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+    checkpoints = sorted(
+        glob.glob(os.path.join(checkpoints_path, "checkpoint_*.pth")),
+        key=lambda path: int(os.path.basename(path)[len("checkpoint_") : -len(".pth")]),
+    )
+    for path in checkpoints[:-keep_checkpoints]:
+        os.remove(path)
+
+
+def train(output_path, train_csv_path, eval_csv_path="", language="en", lr=5e-6, num_epochs=5, batch_size=512, audio_shards_path="", manifest_path="", crop_seconds=4.0, max_batch_seconds=0, bucket_size=2000, grad_accum_steps=1, precision="fp32", save_step=1000, print_step=50, keep_checkpoints=2, continue_path=""):
     dvae_pretrained = os.path.join(output_path, 'XTTS-v2/dvae.pth')
     mel_norm_file = os.path.join(output_path, 'XTTS-v2/mel_stats.pth')
 
+    # step checkpoints and best model, training continues from the last checkpoint of `continue_path`
     now = datetime.datetime.now()
-    now_without_ms = now.replace(microsecond=0)
-    # CHECKPOINTS_OUT_PATH = os.path.join(output_path, f"DVAE_checkpoint_{now_without_ms}/")
-    # os.makedirs(CHECKPOINTS_OUT_PATH, exist_ok=True)
+    CHECKPOINTS_OUT_PATH = continue_path or os.path.join(output_path, f"DVAE_checkpoint_{now:%Y-%m-%d_%H-%M-%S}")
+    os.makedirs(CHECKPOINTS_OUT_PATH, exist_ok=True)
 
     config_dataset = BaseDatasetConfig(
         formatter="coqui",
@@ -73,6 +180,18 @@ def train(output_path, train_csv_path, eval_csv_path="", language="en", lr=5e-6,
     GRAD_CLIP_NORM = 0.5
     LEARNING_RATE = lr
 
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # mixed precision on GPU only, fp32 master weights and loss scaling for fp16
+    use_amp = precision != "fp32" and device.type == "cuda"
+    if precision != "fp32" and not use_amp:
+        print(" > Mixed precision needs a CUDA device, training in fp32.")
+    if use_amp and precision == "bf16" and not torch.cuda.is_bf16_supported():
+        print(" > bf16 is not supported by the GPU, training in fp16 with loss scaling.")
+        precision = "fp16"
+    # unused in fp32, but CPU autocast only accepts bf16 even when disabled
+    amp_dtype = torch.float16 if precision == "fp16" else torch.bfloat16
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp and amp_dtype == torch.float16)
+
     dvae = DiscreteVAE(
                 channels=80,
                 normalization=None,
@@ -86,12 +205,24 @@ def train(output_path, train_csv_path, eval_csv_path="", language="en", lr=5e-6,
                 use_transposed_convs=False,
             )
 
-    dvae.load_state_dict(torch.load(dvae_pretrained), strict=False)
-    dvae.cuda()
+    dvae.load_state_dict(torch.load(dvae_pretrained, map_location=torch.device("cpu")), strict=False)
+    dvae.to(device)
     opt = Adam(dvae.parameters(), lr = LEARNING_RATE)
     torch_mel_spectrogram_dvae = TorchMelSpectrogram(
                 mel_norm_file=mel_norm_file, sampling_rate=22050
-            ).cuda()
+            ).to(device)
+
+    # continue from the last step checkpoint
+    step, start_epoch, epoch_step, best_loss = 0, 0, 0, 1e6
+    last_checkpoint = find_last_checkpoint(CHECKPOINTS_OUT_PATH)
+    if last_checkpoint is not None:
+        checkpoint = torch.load(last_checkpoint, map_location=device)
+        dvae.load_state_dict(checkpoint["model"])
+        opt.load_state_dict(checkpoint["optimizer"])
+        scaler.load_state_dict(checkpoint["scaler"])
+        step, start_epoch, epoch_step = checkpoint["step"], checkpoint["epoch"], checkpoint["epoch_step"]
+        best_loss = checkpoint["best_loss"]
+        print(f" > Training continued from {last_checkpoint} (step {step})")
 
     train_samples, eval_samples = load_tts_samples(
             DATASETS_CONFIG_LIST,
@@ -100,8 +231,23 @@ def train(output_path, train_csv_path, eval_csv_path="", language="en", lr=5e-6,
             eval_split_size=0.01,
         )
 
-    eval_dataset = DVAEDataset(eval_samples, 22050, True, max_wav_len=15*22050)
-    train_dataset = DVAEDataset(train_samples, 22050, False, max_wav_len=15*22050)
+    crop_len = int(crop_seconds * 22050) if crop_seconds else None
+    eval_dataset = DVAEDataset(eval_samples, 22050, True, max_wav_len=15*22050, audio_shards_path=audio_shards_path, manifest_path=manifest_path or None, crop_len=crop_len)
+    train_dataset = DVAEDataset(train_samples, 22050, False, max_wav_len=15*22050, audio_shards_path=audio_shards_path, manifest_path=manifest_path or None, crop_len=crop_len)
+
+    # epochs of every clip once, in batches of clips of similar length and of a single language
+    wav_lengths, languages = train_dataset.get_lengths()
+    batch_sampler = LanguageBucketBatchSampler(
+                        wav_lengths,
+                        [0] * len(wav_lengths),
+                        languages,
+                        batch_size=batch_size,
+                        max_wav_length=int(max_batch_seconds * 22050) if max_batch_seconds else None,
+                        bucket_size=bucket_size,
+                        seed=train_dataset.training_seed,
+                        balance_languages=False,
+                    )
+    train_dataset.use_sampler_index = True
 
     eval_data_loader = DataLoader(
                         eval_dataset,
@@ -115,9 +261,7 @@ def train(output_path, train_csv_path, eval_csv_path="", language="en", lr=5e-6,
 
     train_data_loader = DataLoader(
                         train_dataset,
-                        batch_size=batch_size,
-                        shuffle=False,
-                        drop_last=False,
+                        batch_sampler=batch_sampler,
                         collate_fn=train_dataset.collate_fn,
                         num_workers=4,
                         pin_memory=False,
@@ -129,22 +273,20 @@ def train(output_path, train_csv_path, eval_csv_path="", language="en", lr=5e-6,
     # wandb.init(project = 'train_dvae')
     # wandb.watch(dvae)
 
-    def to_cuda(x: torch.Tensor) -> torch.Tensor:
+    def to_device(x: torch.Tensor) -> torch.Tensor:
         if x is None:
             return None
         if torch.is_tensor(x):
-            x = x.contiguous()
-            if torch.cuda.is_available():
-                x = x.cuda(non_blocking=True)
+            x = x.contiguous().to(device, non_blocking=True)
         return x
 
     @torch.no_grad()
     def format_batch(batch):
         if isinstance(batch, dict):
             for k, v in batch.items():
-                batch[k] = to_cuda(v)
+                batch[k] = to_device(v)
         elif isinstance(batch, list):
-            batch = [to_cuda(v) for v in batch]
+            batch = [to_device(v) for v in batch]
 
         try:
             batch['mel'] = torch_mel_spectrogram_dvae(batch['wav'])
@@ -157,47 +299,74 @@ def train(output_path, train_csv_path, eval_csv_path="", language="en", lr=5e-6,
             pass
         return batch
 
-    best_loss = 1e6
+    def get_state(epoch, epoch_step):
+        return {
+            "model": dvae.state_dict(),
+            "optimizer": opt.state_dict(),
+            "scaler": scaler.state_dict(),
+            "step": step,
+            "epoch": epoch,
+            "epoch_step": epoch_step,
+            "best_loss": best_loss,
+        }
 
-    for i in range(num_epochs):
+    best_model_path = os.path.join(CHECKPOINTS_OUT_PATH, "best_model.pth")
+    logger = ThroughputLogger(print_step, 22050)
+
+    for i in range(start_epoch, num_epochs):
         dvae.train()
-        for cur_step, batch in enumerate(train_data_loader):
-            opt.zero_grad()
+        opt.zero_grad(set_to_none=True)
+        logger.reset()
+        # the batches only depend on the epoch, a continued epoch skips the batches already done
+        batch_sampler.set_epoch(i)
+        batch_sampler.start_batch = epoch_step
+        num_batches = len(batch_sampler)
+        for batch in train_data_loader:
+            num_audio_samples = batch['wav_lengths'].sum().item()  # on the host, no sync
             batch = format_batch(batch)
-            recon_loss, commitment_loss, out = dvae(batch['mel'])
-            recon_loss = recon_loss.mean()
-            total_loss = recon_loss + commitment_loss
-            # print(f"commitment_loss shape: {commitment_loss.shape}")
-            # print(f"recon_loss shape: {recon_loss.shape}")
-            # print(f"total_loss shape: {total_loss.shape}")
-            total_loss.backward()
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                recon_loss, commitment_loss, out = dvae(batch['mel'])
+                recon_loss = recon_loss.mean()
+                total_loss = recon_loss + commitment_loss
+            scaler.scale(total_loss / grad_accum_steps).backward()
+            logger.update(
+                {'loss': total_loss, 'recon_loss': recon_loss, 'commit_loss': commitment_loss},
+                len(batch['wav_lengths']),
+                num_audio_samples,
+            )
+            epoch_step += 1
+            if epoch_step % grad_accum_steps != 0 and epoch_step != num_batches:
+                continue
+            scaler.unscale_(opt)
             clip_grad_norm_(dvae.parameters(), GRAD_CLIP_NORM)
-            opt.step()
-
-            log = {'epoch': i,
-                'cur_step': cur_step,
-                'loss': total_loss.item(),
-                'recon_loss': recon_loss.item(),
-                'commit_loss': commitment_loss.item()}
-            print(f"epoch: {i}", print(f"step: {cur_step}"), f'loss - {total_loss.item()}', f'recon_loss - {recon_loss.item()}', f'commit_loss - {commitment_loss.item()}')
-            # wandb.log(log)
-            torch.cuda.empty_cache()
-        
+            scaler.step(opt)
+            scaler.update()
+            opt.zero_grad(set_to_none=True)
+            step += 1
+            logger.log(i, step)
+            if step % save_step == 0:
+                save_checkpoint(CHECKPOINTS_OUT_PATH, get_state(i, epoch_step), keep_checkpoints)
+        epoch_step = 0
+
         with torch.no_grad():
             dvae.eval()
             eval_loss = 0
             for cur_step, batch in enumerate(eval_data_loader):
                 batch = format_batch(batch)
-                recon_loss, commitment_loss, out = dvae(batch['mel'])
-                recon_loss = recon_loss.mean()
-                eval_loss += (recon_loss + commitment_loss).item()
-            eval_loss = eval_loss/len(eval_data_loader)
+                with torch.autocast(device.type, dtype=amp_dtype, enabled=use_amp):
+                    recon_loss, commitment_loss, out = dvae(batch['mel'])
+                    recon_loss = recon_loss.mean()
+                eval_loss += (recon_loss + commitment_loss).float()
+            eval_loss = float(eval_loss)/len(eval_data_loader)
             if eval_loss < best_loss:
                 best_loss = eval_loss
-                torch.save(dvae.state_dict(), dvae_pretrained)
+                torch.save(dvae.state_dict(), best_model_path)
             print(f"#######################################\nepoch: {i}\tEVAL loss: {eval_loss}\n#######################################")
+        # end of epoch checkpoint, continues with the next epoch
+        save_checkpoint(CHECKPOINTS_OUT_PATH, get_state(i + 1, 0), keep_checkpoints)
 
-    print(f'Checkpoint saved at {dvae_pretrained}')
+    print(f'Best model saved at {best_model_path}, pass it to train_gpt_xtts.py with --dvae_checkpoint')
+    return best_model_path
 
 
 if __name__ == "__main__":
@@ -212,5 +381,16 @@ if __name__ == "__main__":
         output_path=args.output_path,
         num_epochs=args.num_epochs,
         batch_size=args.batch_size,
-        lr=args.lr
+        lr=args.lr,
+        audio_shards_path=args.audio_shards_path,
+        manifest_path=args.manifest_path,
+        crop_seconds=args.crop_seconds,
+        max_batch_seconds=args.max_batch_seconds,
+        bucket_size=args.bucket_size,
+        grad_accum_steps=args.grad_accum_steps,
+        precision=args.precision,
+        save_step=args.save_step,
+        print_step=args.print_step,
+        keep_checkpoints=args.keep_checkpoints,
+        continue_path=args.continue_path,
     )
\ No newline at end of file
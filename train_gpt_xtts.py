@@ -37,12 +37,42 @@ def create_xtts_trainer_parser():
                         help="Learning rate")
     parser.add_argument("--save_step", type=int, default=5000,
                         help="Save step")
+    parser.add_argument("--dvae_checkpoint", type=str, default="",
+                        help="DVAE checkpoint computing the audio codes, e.g. the best_model.pth of train_dvae_xtts.py. Defaults to the pretrained XTTS-v2/dvae.pth")
+    parser.add_argument("--dvae_codes_path", type=str, default="",
+                        help="DVAE codes precomputed with precompute_dvae_codes.py")
+    parser.add_argument("--audio_shards_path", type=str, default="",
+                        help="Audio packed with pack_audio_shards.py, read instead of the audio files")
+    parser.add_argument("--sample_manifest_path", type=str, default="",
+                        help="JSON file caching the sample lengths used to filter and bucket the samples")
+    parser.add_argument("--audio_cache_dir", type=str, default="",
+                        help="Directory to cache the decoded training audio across epochs")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "fp16", "bf16"],
+                        help="Training precision, fp16 and bf16 use mixed precision with fp32 weights (CUDA only)")
+    parser.add_argument("--attn_implementation", type=str, default=None, choices=["eager", "sdpa", "flash_attention_2"],
+                        help="Attention kernel of the GPT, sdpa uses the fused PyTorch kernels. Defaults to the transformers default")
+    parser.add_argument("--checkpoint_every_n_layers", type=int, default=0,
+                        help="Recompute the activations of one GPT layer out of N in the backward pass to save memory, 0 disables it")
+    parser.add_argument("--freeze_layers", type=int, default=0,
+                        help="Number of lowest GPT layers to freeze")
+    parser.add_argument("--optimizer_8bit", action="store_true",
+                        help="Keep the optimizer state in 8 bits (needs bitsandbytes)")
+    parser.add_argument("--use_length_bucketing", action="store_true",
+                        help="Batch samples of similar lengths together, balancing the languages")
+    parser.add_argument("--bucket_size", type=int, default=2000,
+                        help="Number of samples sorted by length together when bucketing")
+    parser.add_argument("--max_tokens_per_batch", type=int, default=None,
+                        help="Maximum padded GPT tokens (text tokens + audio codes) per batch, replaces the fixed batch size")
+    parser.add_argument("--max_audio_seconds_per_batch", type=float, default=None,
+                        help="Maximum padded audio seconds per batch, replaces the fixed batch size")
+    parser.add_argument("--max_text_tokens_per_batch", type=int, default=None,
+                        help="Maximum padded text tokens per batch, replaces the fixed batch size")
 
     return parser
 
 
 
-def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_audio_length, max_text_length, lr, weight_decay, save_step):
+def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_audio_length, max_text_length, lr, weight_decay, save_step, dvae_checkpoint="", dvae_codes_path="", audio_shards_path="", sample_manifest_path="", audio_cache_dir="", precision="fp32", attn_implementation=None, checkpoint_every_n_layers=0, freeze_layers=0, optimizer_8bit=False, use_length_bucketing=False, bucket_size=2000, max_tokens_per_batch=None, max_audio_seconds_per_batch=None, max_text_tokens_per_batch=None, trainer_argv=None):
     #  Logging parameters
     RUN_NAME = "GPT_XTTS_FT"
     PROJECT_NAME = "XTTS_trainer"
@@ -54,7 +84,7 @@ def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_au
     OUT_PATH = output_path
 
     # Training Parameters
-    OPTIMIZER_WD_ONLY_ON_WEIGHTS = True  # for multi-gpu training please make it False
+    OPTIMIZER_WD_ONLY_ON_WEIGHTS = True  # the parameter groups are built from the unwrapped GPT, so it works with DDP too
     START_WITH_EVAL = False  # if True it will star with evaluation
     BATCH_SIZE = batch_size  # set here the batch size
     GRAD_ACUMM_STEPS = grad_acumm  # set here the grad accumulation steps
@@ -89,6 +119,9 @@ def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_au
     # Set the path to the downloaded files
     DVAE_CHECKPOINT = os.path.join(CHECKPOINTS_OUT_PATH, os.path.basename(DVAE_CHECKPOINT_LINK))
     MEL_NORM_FILE = os.path.join(CHECKPOINTS_OUT_PATH, os.path.basename(MEL_NORM_LINK))
+    # fine-tuned DVAE, if given, instead of the pretrained one
+    if dvae_checkpoint and not os.path.isfile(dvae_checkpoint):
+        raise FileNotFoundError(f"DVAE checkpoint not found: {dvae_checkpoint}")
 
     # download DVAE files if needed
     if not os.path.isfile(DVAE_CHECKPOINT) or not os.path.isfile(MEL_NORM_FILE):
@@ -131,7 +164,11 @@ def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_au
         max_wav_length=max_audio_length,  # ~11.6 seconds
         max_text_length=max_text_length,
         mel_norm_file=MEL_NORM_FILE,
-        dvae_checkpoint=DVAE_CHECKPOINT,
+        dvae_checkpoint=dvae_checkpoint or DVAE_CHECKPOINT,
+        dvae_codes_path=dvae_codes_path,
+        audio_shards_path=audio_shards_path,
+        sample_manifest_path=sample_manifest_path,
+        audio_cache_dir=audio_cache_dir,
         xtts_checkpoint=XTTS_CHECKPOINT,  # checkpoint path of the model that you want to fine-tune
         tokenizer_file=TOKENIZER_FILE,
         gpt_num_audio_tokens=1026,
@@ -139,6 +176,7 @@ def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_au
         gpt_stop_audio_token=1025,
         gpt_use_masking_gt_prompt_approach=True,
         gpt_use_perceiver_resampler=True,
+        gpt_attn_implementation=attn_implementation,
     )
     # define audio config
     audio_config = XttsAudioConfig(sample_rate=22050, dvae_sample_rate=22050, output_sample_rate=24000)
@@ -160,6 +198,9 @@ def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_au
     config.logger_uri = LOGGER_URI
     config.audio = audio_config
     config.batch_size = BATCH_SIZE
+    config.mixed_precision = precision != "fp32"
+    if config.mixed_precision:
+        config.precision = precision
     config.num_loader_workers = 8
     config.eval_split_max_size = 256
     config.print_step = 50
@@ -172,6 +213,14 @@ def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_au
     config.optimizer = "AdamW"
     config.optimizer_wd_only_on_weights = OPTIMIZER_WD_ONLY_ON_WEIGHTS
     config.optimizer_params = {"betas": [0.9, 0.96], "eps": 1e-8, "weight_decay": weight_decay}
+    config.optimizer_8bit = optimizer_8bit
+    config.gpt_checkpoint_every_n_layers = checkpoint_every_n_layers
+    config.gpt_freeze_layers = freeze_layers
+    config.use_length_bucketing = use_length_bucketing
+    config.bucket_size = bucket_size
+    config.max_tokens_per_batch = max_tokens_per_batch
+    config.max_audio_seconds_per_batch = max_audio_seconds_per_batch
+    config.max_text_tokens_per_batch = max_text_tokens_per_batch
     config.lr = lr
     config.lr_scheduler = "MultiStepLR"
     config.lr_scheduler_params = {"milestones": [50000 * 18, 150000 * 18, 300000 * 18], "gamma": 0.5, "last_epoch": -1}
@@ -188,14 +237,19 @@ def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_au
         eval_split_size=config.eval_split_size,
     )
 
+    trainer_args = TrainerArgs(
+        restore_path=None,  # xtts checkpoint is restored via xtts_checkpoint key so no need of restore it using Trainer restore_path parameter
+        skip_train_epoch=False,
+        start_with_eval=START_WITH_EVAL,
+        grad_accum_steps=GRAD_ACUMM_STEPS
+    )
+    if trainer_argv:
+        # --use_ddp, --rank and --group_id set by `python -m trainer.distribute` for multi-GPU training
+        trainer_args.parse_known_args(trainer_argv, arg_prefix="")
+
     # init the trainer and 🚀
     trainer = Trainer(
-        TrainerArgs(
-            restore_path=None,  # xtts checkpoint is restored via xtts_checkpoint key so no need of restore it using Trainer restore_path parameter
-            skip_train_epoch=False,
-            start_with_eval=START_WITH_EVAL,
-            grad_accum_steps=GRAD_ACUMM_STEPS
-        ),
+        trainer_args,
         config,
         output_path=os.path.join(output_path, "run", "training"),
         model=model,
@@ -219,7 +273,8 @@ def train_gpt(metadatas, num_epochs, batch_size, grad_acumm, output_path, max_au
 
 if __name__ == "__main__":
     parser = create_xtts_trainer_parser()
-    args = parser.parse_args()
+    # the remaining arguments are for the Trainer, e.g. the DDP arguments of `python -m trainer.distribute`
+    args, trainer_argv = parser.parse_known_args()
 
     trainer_out_path = train_gpt(
         metadatas=args.metadatas,
@@ -231,7 +286,23 @@ if __name__ == "__main__":
         lr=args.lr,
         max_text_length=args.max_text_length,
         max_audio_length=args.max_audio_length,
-        save_step=args.save_step
+        save_step=args.save_step,
+        dvae_checkpoint=args.dvae_checkpoint,
+        dvae_codes_path=args.dvae_codes_path,
+        audio_shards_path=args.audio_shards_path,
+        sample_manifest_path=args.sample_manifest_path,
+        audio_cache_dir=args.audio_cache_dir,
+        precision=args.precision,
+        attn_implementation=args.attn_implementation,
+        checkpoint_every_n_layers=args.checkpoint_every_n_layers,
+        freeze_layers=args.freeze_layers,
+        optimizer_8bit=args.optimizer_8bit,
+        use_length_bucketing=args.use_length_bucketing,
+        bucket_size=args.bucket_size,
+        max_tokens_per_batch=args.max_tokens_per_batch,
+        max_audio_seconds_per_batch=args.max_audio_seconds_per_batch,
+        max_text_tokens_per_batch=args.max_text_tokens_per_batch,
+        trainer_argv=trainer_argv,
     )
 
     print(f"Checkpoint saved in dir: {trainer_out_path}")